@@ -0,0 +1,94 @@
+# Times crediting open deposits with the old one row at a time loop and
+# with the process_deposits() SQL function, optionally from several
+# workers at once. Run against a scratch database with the schema and
+# at least one account loaded.
+#
+#   $ python3 bench/deposits.py postgresql://localhost/borse_bench \
+#         --deposits 100000 --workers 4
+
+import argparse
+import asyncio
+import asyncpg
+import sys
+import time
+
+async def seed(pool, deposits):
+    async with pool.acquire() as db:
+        await db.execute('''
+            insert into account_events (account_id, event, amount, fee)
+            select account_id, 'Deposit', 1, 0
+            from generate_series(1, $1) as i
+            join lateral (
+                select account_id from accounts
+                order by account_id
+                offset i % (select count(*) from accounts)
+                limit 1
+            ) as account on true
+        ''', deposits)
+
+# The loop Application.process_deposits used to run
+async def process_row_by_row(pool):
+    async with pool.acquire() as db:
+        async with db.transaction():
+            async for event_id, account_id, amount in db.cursor('''
+                select account_event_id, account_id, amount
+                from account_events
+                where event = 'Deposit' and status = 'Open'
+            '''):
+                await db.execute('''
+                    update accounts
+                    set balance = balance + $1
+                    where account_id = $2
+                ''', amount, account_id)
+                await db.execute('''
+                    update account_events
+                    set status = 'Closed'
+                    where account_event_id = $1
+                ''', event_id)
+
+async def process_batched(pool, batch_size):
+    async with pool.acquire() as db:
+        while await db.fetchval('select process_deposits($1)',
+                                batch_size) == batch_size:
+            pass
+
+async def measure(name, pool, deposits, run):
+    await seed(pool, deposits)
+    start = time.perf_counter()
+    await run()
+    elapsed = time.perf_counter() - start
+
+    async with pool.acquire() as db:
+        remaining = await db.fetchval('''
+            select count(*) from account_events
+            where event = 'Deposit' and status = 'Open'
+        ''')
+    print('%-24s %8d deposits  %8.3f s  %10.0f deposits/s  %d left open' % (
+        name, deposits, elapsed, deposits / elapsed, remaining))
+
+async def run(args):
+    pool = await asyncpg.create_pool(args.dsn, min_size=args.workers,
+                                     max_size=args.workers)
+    try:
+        await measure('row by row', pool, args.deposits,
+                      lambda: process_row_by_row(pool))
+        await measure('batched x%d' % args.workers, pool, args.deposits,
+                      lambda: asyncio.gather(*[
+                          process_batched(pool, args.batch_size)
+                          for _ in range(args.workers)]))
+    finally:
+        await pool.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dsn')
+    parser.add_argument('--deposits', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
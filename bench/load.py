@@ -0,0 +1,349 @@
+# Drives a running server.py with simulated users, speaking the same
+# signed protocol as client.py. Requests arrive at a fixed average rate
+# whether or not earlier ones were answered, so a slow server shows up
+# as latency instead of a lower request rate. Users are funded directly
+# in the database, so point --dsn at the server's database.
+#
+#   $ BORSE_MATCHING_ENGINE=memory python3 server.py &
+#   $ python3 bench/load.py --users 50 --rate 500 --duration 60 \
+#         --mix place_order=5,fetch_orderbook=3,fetch_trades=2
+#
+# --resume reconnects every user once logged in, with resume_session
+# instead of the password, and reports how long that took.
+#
+# --wire msgpack asks for the binary subprotocol, which needs the msgpack
+# package, --no-compression turns off permessage-deflate.
+#
+# Order to trade latency is measured on its own pair (--probe-pair): a
+# resting sell and a crossing buy are placed with an amount no other
+# order uses, and the time is taken from sending the buy until the
+# trade event for that amount arrives. This needs the server's memory
+# matching engine. The sql engine only tries the best bid over all
+# pairs, so probe orders never match while a load order on another pair
+# is resting above them.
+
+import argparse
+import asyncio
+import asyncpg
+import collections
+import decimal
+import ed25519
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import uuid
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from client import sign
+
+# imported by main() for --wire msgpack
+msgpack = None
+
+class RequestFailed(Exception):
+    pass
+
+class User:
+
+    def __init__(self, username, url, wire, compression):
+        self.username = username
+        self.password = username
+        self.url = url
+        self.wire = wire
+        self.compression = compression
+        self.websocket = None
+        self.session = []
+        self.ident = itertools.count()
+        # request id -> future for the reply
+        self.pending = {}
+        # streamed replies received so far
+        self.partial_results = {}
+        self.event_handler = None
+
+    async def connect(self):
+        self.websocket = await websockets.connect(
+            self.url, max_size=None, subprotocols=['borse.' + self.wire],
+            compression=self.compression)
+        asyncio.ensure_future(self.read_replies())
+
+    async def read_replies(self):
+        async for reply in self.websocket:
+            if isinstance(reply, bytes):
+                reply = msgpack.unpackb(reply)
+            else:
+                reply = json.loads(reply)
+
+            if 'event' in reply:
+                if self.event_handler is not None:
+                    self.event_handler(reply)
+                continue
+
+            if reply.get('more'):
+                self.partial_results.setdefault(reply['id'], []).extend(
+                    reply['result'])
+                continue
+            if reply['id'] in self.partial_results:
+                reply['result'] = (self.partial_results.pop(reply['id']) +
+                                   reply['result'])
+
+            future = self.pending.pop(reply['id'], None)
+            if future is not None and not future.done():
+                future.set_result(reply)
+
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(RequestFailed('connection closed'))
+
+    async def request(self, command, params):
+        ident = next(self.ident)
+        request = {
+            'command': command,
+            'id': ident,
+            'params': params
+        }
+        if self.wire == 'msgpack':
+            message = msgpack.packb(request)
+            if self.session:
+                signature = self.session[0].sign(message, encoding='base64')
+                message = msgpack.packb({
+                    'payload': message, 'signature': signature.decode()})
+        else:
+            message = json.dumps(request)
+            if self.session:
+                message = sign(message, self.session)
+
+        future = self.pending[ident] = \
+            asyncio.get_event_loop().create_future()
+        await self.websocket.send(message)
+        return await future
+
+    async def login(self):
+        reply = await self.request('register', [
+            self.username, self.username + '@load.test', self.password])
+        if reply['error'] not in (None, 'duplicate username'):
+            raise RequestFailed('register: %s' % reply['error'])
+
+        private_key, public_key = ed25519.create_keypair()
+        session_key = public_key.to_ascii(encoding='hex').decode()
+        reply = await self.request('login', [
+            self.username, self.password, session_key])
+        if reply['error'] is not None:
+            raise RequestFailed('login: %s' % reply['error'])
+        self.session.append(private_key)
+        self.session_key = session_key
+
+    async def resume(self):
+        await self.websocket.close()
+        private_key = self.session.pop()
+        await self.connect()
+
+        reply = await self.request('session_nonce', [])
+        signature = private_key.sign(reply['result'].encode(),
+                                     encoding='base64')
+        reply = await self.request('resume_session', [
+            self.session_key, signature.decode()])
+        if reply['error'] is not None:
+            raise RequestFailed('resume_session: %s' % reply['error'])
+        self.session.append(private_key)
+
+def parse_mix(mix):
+    commands, weights = [], []
+    for item in mix.split(','):
+        command, _, weight = item.partition('=')
+        commands.append(command)
+        weights.append(float(weight or 1))
+    return commands, weights
+
+def make_params(command, pairs, mid_price):
+    base, quote = random.choice(pairs)
+    if command == 'place_order':
+        price = mid_price * decimal.Decimal(random.uniform(0.99, 1.01))
+        amount = decimal.Decimal(random.uniform(0.001, 1))
+        return [base, quote, f'{price:.4f}', f'{amount:.4f}',
+                random.choice(('Buy', 'Sell'))]
+    return [base, quote]
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report_row(name, latencies, errors, elapsed):
+    print('%-16s %8d %6d %10.1f %10.2f %10.2f %10.2f' % (
+        name, len(latencies), errors, len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        percentile(latencies, 0.999) * 1000))
+
+class Load:
+
+    def __init__(self, args):
+        self.args = args
+        self.pairs = [tuple(pair.split('/')) for pair in args.pairs.split(',')]
+        self.commands, self.weights = parse_mix(args.mix)
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.trade_latencies = []
+        # probe amount -> time the crossing buy was sent
+        self.probes = {}
+        self.outstanding = set()
+
+    async def setup_users(self):
+        prefix = self.args.prefix or 'load_' + uuid.uuid4().hex[:8]
+        compression = None if self.args.no_compression else 'deflate'
+        users = [User('%s_%s' % (prefix, i), self.args.url, self.args.wire,
+                      compression)
+                 for i in range(self.args.users + 1)]
+        for user in users:
+            await user.connect()
+        await asyncio.gather(*[user.login() for user in users])
+
+        db = await asyncpg.connect(self.args.dsn)
+        try:
+            await db.execute('''
+                update accounts set balance = $2
+                where user_id in (
+                    select user_id from users where username like $1
+                )
+            ''', prefix + '\\_%', self.args.balance)
+        finally:
+            await db.close()
+
+        if self.args.resume:
+            start = time.perf_counter()
+            await asyncio.gather(*[user.resume() for user in users])
+            print('%s sessions resumed in %.3f s' % (
+                len(users), time.perf_counter() - start))
+
+        # the last user only places probe orders
+        return users[:-1], users[-1]
+
+    async def timed_request(self, user, command, params):
+        start = time.perf_counter()
+        try:
+            reply = await user.request(command, params)
+        except (RequestFailed, websockets.exceptions.ConnectionClosed):
+            self.errors[command] += 1
+            return
+        if reply['error'] is not None:
+            self.errors[command] += 1
+            return
+        self.latencies[command].append(time.perf_counter() - start)
+
+    def start_request(self, user, command, params):
+        task = asyncio.ensure_future(self.timed_request(user, command, params))
+        self.outstanding.add(task)
+        task.add_done_callback(self.outstanding.discard)
+
+    async def generate(self, users, deadline):
+        loop = asyncio.get_event_loop()
+        next_time = loop.time()
+        while next_time < deadline:
+            # Poisson arrivals at the requested rate
+            next_time += random.expovariate(self.args.rate)
+            await asyncio.sleep(max(0, next_time - loop.time()))
+
+            command = random.choices(self.commands, self.weights)[0]
+            params = make_params(command, self.pairs,
+                                 decimal.Decimal(self.args.mid_price))
+            self.start_request(random.choice(users), command, params)
+
+    def on_probe_event(self, reply):
+        if reply['event'] != 'trades':
+            return
+        now = time.perf_counter()
+        for trade in reply['data']:
+            start = self.probes.pop(decimal.Decimal(trade['amount']), None)
+            if start is not None:
+                self.trade_latencies.append(now - start)
+
+    async def probe(self, user, deadline):
+        base, quote = self.args.probe_pair.split('/')
+        user.event_handler = self.on_probe_event
+        await user.request('subscribe', ['trades:%s/%s' % (base, quote)])
+
+        loop = asyncio.get_event_loop()
+        for i in itertools.count():
+            if loop.time() >= deadline:
+                break
+            amount = decimal.Decimal('1.0001') + decimal.Decimal(i % 9999) / \
+                10000
+            params = [base, quote, '1.0000', f'{amount:.4f}']
+
+            reply = await user.request('place_order', params + ['Sell'])
+            if reply['error'] is None:
+                self.probes[amount] = time.perf_counter()
+                await user.request('place_order', params + ['Buy'])
+            await asyncio.sleep(self.args.probe_interval)
+
+    async def run(self):
+        users, prober = await self.setup_users()
+        print('%s users logged in' % len(users))
+
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        deadline = loop.time() + self.args.duration
+        await asyncio.gather(self.generate(users, deadline),
+                             self.probe(prober, deadline))
+        if self.outstanding:
+            await asyncio.wait(self.outstanding, timeout=self.args.drain)
+        elapsed = time.perf_counter() - start
+        # trade events still on their way
+        await asyncio.sleep(min(self.args.drain, 1))
+
+        print('%-16s %8s %6s %10s %10s %10s %10s' % (
+            'command', 'done', 'errors', 'per s', 'p50 ms', 'p99 ms',
+            'p999 ms'))
+        for command in self.commands:
+            report_row(command, self.latencies[command],
+                       self.errors[command], elapsed)
+        report_row('all', list(itertools.chain(*self.latencies.values())),
+                   sum(self.errors.values()), elapsed)
+        report_row('order to trade', self.trade_latencies,
+                   len(self.probes), elapsed)
+        if self.probes and not self.trade_latencies:
+            print('no probe order traded, is the server running with '
+                  'BORSE_MATCHING_ENGINE=memory?')
+        print('%s requests still unanswered' % len(self.outstanding))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='ws://localhost:8765')
+    parser.add_argument('--dsn', default='postgresql://localhost/borse')
+    parser.add_argument('--wire', choices=('json', 'msgpack'),
+                        default='json')
+    parser.add_argument('--no-compression', action='store_true')
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--prefix',
+                        help='username prefix, reuses earlier users')
+    parser.add_argument('--balance', type=decimal.Decimal,
+                        default=decimal.Decimal('1000000000'))
+    parser.add_argument('--rate', type=float, default=200,
+                        help='requests per second over all users')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--drain', type=float, default=10,
+                        help='seconds to wait for unanswered requests')
+    parser.add_argument('--mix',
+                        default='place_order=5,fetch_orderbook=3,'
+                                'fetch_trades=2')
+    parser.add_argument('--pairs', default='BTC/USD')
+    parser.add_argument('--mid-price', default='5000')
+    parser.add_argument('--probe-pair', default='ETH/EUR')
+    parser.add_argument('--probe-interval', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.wire == 'msgpack':
+        global msgpack
+        import msgpack
+
+    asyncio.get_event_loop().run_until_complete(Load(args).run())
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
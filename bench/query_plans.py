@@ -0,0 +1,199 @@
+# Seeds a scratch database with the schema loaded and reports
+# EXPLAIN ANALYZE timings for the hot queries. Exits with an error if
+# any of them falls back to a sequential scan on a large table.
+#
+#   $ python3 bench/query_plans.py postgresql://localhost/borse_bench --seed
+
+import argparse
+import asyncio
+import asyncpg
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import borse.queries
+
+large_tables = ('orders', 'trades', 'account_events')
+
+# Arguments for the statements of borse.queries that only read, which
+# are explained as the server runs them
+read_query_args = {
+    'password_authentication': ('bench_1',),
+    'active_session': (bytes(32),),
+    'trades_last_24_hours': ('BTC', 'USD', 0, 500),
+    'trades_page': ('BTC', 'USD', 0, 1000),
+    'fetch_accounts': (1,),
+    'query_ticker_info': ('BTC', 'USD'),
+    'fetch_candles': ('BTC', 'USD', 'hour', time.time() - 30 * 86400,
+                      time.time(), 1000),
+    'deposit_address': (1,),
+    'current_bitcoin_chain_index': (1,),
+    'open_orders': (None,),
+}
+
+# The others write, explain analyze would run them. The hot statements
+# inside them are copied from schema/trade_engine.sql and
+# schema/functions.sql, explain does not look into functions.
+write_queries = {
+    'create_user', 'log_password_login_attempt', 'login', 'touch_session',
+    'revoke_session', 'place_order', 'make_withdraw_bitcoin_request',
+    'record_trade', 'match_orders', 'process_deposits'
+}
+function_queries = {
+    'match_one_order (buy)': ("""
+        select * from orders
+        where order_type = 'Buy' and status = 'Open'
+        order by price desc limit 1
+    """, ()),
+    'match_one_order (sell)': ("""
+        select * from orders
+        where
+            order_type = 'Sell' and price <= 5500 and
+            base_currency = 'BTC' and quote_currency = 'USD' and
+            status = 'Open'
+        order by price asc limit 1
+    """, ()),
+    'process_deposits': ("""
+        select account_event_id, account_id, amount
+        from account_events
+        where event = 'Deposit' and status = 'Open'
+        order by account_event_id
+        limit $1
+    """, (1000,)),
+}
+
+def make_queries():
+    unknown = (set(borse.queries.queries) - set(read_query_args) -
+               write_queries)
+    if unknown:
+        raise SystemExit('no arguments for: %s' % ', '.join(sorted(unknown)))
+
+    queries = {name: (borse.queries.queries[name], args)
+               for name, args in read_query_args.items()}
+    queries.update(function_queries)
+    return queries
+
+async def seed(db, users, orders, trades, deposits):
+    print('Seeding %s users, %s orders, %s trades, %s deposits' % (
+        users, orders, trades, deposits))
+
+    await db.execute('''
+        insert into users (username, email)
+        select 'bench_' || i, 'bench_' || i || '@bench.com'
+        from generate_series(1, $1) as i
+        on conflict do nothing
+    ''', users)
+    await db.execute('''
+        insert into accounts (user_id, currency_code)
+        select user_id, currency_code from users, currencies
+        where username like 'bench\\_%'
+        on conflict do nothing
+    ''')
+
+    first_user = await db.fetchval(
+        "select min(user_id) from users where username like 'bench\\_%'")
+
+    first_order = await db.fetchval(
+        'select coalesce(max(order_id), 0) + 1 from orders')
+    await db.execute('''
+        insert into orders (
+            user_id, base_currency, quote_currency, price, amount,
+            status, order_type, created_at
+        )
+        select
+            $1 + i % $2,
+            (array['BTC', 'ETH'])[1 + i % 2],
+            (array['USD', 'EUR'])[1 + (i / 2) % 2],
+            round((5000 + random() * 1000)::numeric, 2),
+            round((0.01 + random() * 10)::numeric, 4),
+            case when random() < 0.02 then 'Open' else 'Closed' end
+                ::status_type,
+            case when i % 3 = 0 then 'Buy' else 'Sell' end
+                ::order_enum_type,
+            now() - random() * interval '30 days'
+        from generate_series(0, $3 - 1) as i
+    ''', first_user, users, orders)
+
+    await db.execute('''
+        insert into trades (
+            trade_price, trade_amount, buy_id, buy_fee, sell_id, sell_fee,
+            created_at
+        )
+        select
+            round((5000 + random() * 1000)::numeric, 2),
+            round((0.01 + random() * 10)::numeric, 4),
+            $1 + (random() * ($2 - 1))::int, 0,
+            $1 + (random() * ($2 - 1))::int, 0,
+            now() - random() * interval '30 days'
+        from generate_series(1, $3)
+    ''', first_order, orders, trades)
+
+    await db.execute('''
+        insert into account_events (account_id, event, amount, fee, status)
+        select
+            account_id, 'Deposit', 1, 0,
+            case when random() < 0.01 then 'Open' else 'Closed' end
+                ::status_type
+        from generate_series(1, $1) as i
+        join lateral (
+            select account_id from accounts
+            where user_id = $2 + i % $3 and currency_code = 'BTC'
+        ) as account on true
+    ''', deposits, first_user, users)
+
+    await db.execute('analyze')
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from plan_nodes(child)
+
+async def explain(db, name, query, args):
+    result = await db.fetchval(
+        'explain (analyze, buffers, format json) ' + query, *args)
+    result = json.loads(result)[0]
+
+    seq_scans = [node['Relation Name'] for node in plan_nodes(result['Plan'])
+                 if node['Node Type'] == 'Seq Scan' and
+                    node['Relation Name'] in large_tables]
+
+    print('%-24s planning %8.3f ms  execution %10.3f ms  %s' % (
+        name, result['Planning Time'], result['Execution Time'],
+        'seq scan on ' + ', '.join(seq_scans) if seq_scans else ''))
+    return not seq_scans
+
+async def run(args):
+    db = await asyncpg.connect(args.dsn)
+    try:
+        if args.seed:
+            await seed(db, args.users, args.orders, args.trades,
+                       args.deposits)
+
+        passed = True
+        for name, (query, query_args) in make_queries().items():
+            passed &= await explain(db, name, query, query_args)
+    finally:
+        await db.close()
+
+    return passed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dsn')
+    parser.add_argument('--seed', action='store_true',
+                        help='insert benchmark rows before explaining')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--trades', type=int, default=5000000)
+    parser.add_argument('--deposits', type=int, default=100000)
+    args = parser.parse_args()
+
+    if not asyncio.get_event_loop().run_until_complete(run(args)):
+        return -1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
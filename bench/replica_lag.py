@@ -0,0 +1,121 @@
+# Prints the replication lag the server would see between a primary and
+# a replica, and whether read only requests would be sent to the
+# replica. For a local setup, with a streaming standby on port 5433:
+#
+#   $ pg_basebackup -D /tmp/replica -R -X stream
+#   $ pg_ctl -D /tmp/replica -o '-p 5433' start
+#   $ python3 bench/replica_lag.py postgresql://localhost/borse \
+#         postgresql://localhost:5433/borse
+#
+# and run the server with BORSE_READ_DATABASE_DSN set to the second DSN.
+#
+# --check tests the routing instead: it pauses replay on the replica,
+# writes on the primary until the lag passes --max-lag, and fails unless
+# read only requests are then sent to the primary, and to the replica
+# again once replay has resumed. Pausing replay needs a superuser or a
+# role allowed to run pg_wal_replay_pause().
+
+import argparse
+import asyncio
+import asyncpg
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from borse.replica import ReadReplica
+
+# whether read only requests are sent to the replica right now
+async def routed_to_replica(replica):
+    async with replica.acquire(True) as db:
+        return await db.fetchval('select pg_is_in_recovery()')
+
+async def wait_for_route(replica, to_replica, timeout):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if await routed_to_replica(replica) == to_replica:
+            return True
+        await asyncio.sleep(replica.interval / 4)
+    return False
+
+async def check(replica, args):
+    monitor = asyncio.ensure_future(replica.monitor())
+    # every check waits this long for the monitor to react
+    timeout = args.max_lag + 5 * args.interval
+    try:
+        if not await wait_for_route(replica, True, timeout):
+            print('FAIL: read only requests never use the replica')
+            return False
+        print('ok: read only requests use the replica')
+
+        async with replica.read_pool.acquire() as db:
+            await db.execute('select pg_wal_replay_pause()')
+        try:
+            loop = asyncio.get_event_loop()
+            deadline = loop.time() + timeout
+            while loop.time() < deadline and replica.is_usable:
+                # commits, so the replica falls behind the primary
+                async with replica.pool.acquire() as db:
+                    await db.execute('select txid_current()')
+                await asyncio.sleep(args.interval / 4)
+
+            if not await wait_for_route(replica, False, 1):
+                print('FAIL: read only requests still use the replica, '
+                      'lag %s' % replica.lag)
+                return False
+            print('ok: read only requests use the primary, lag %s' %
+                  replica.lag)
+        finally:
+            async with replica.read_pool.acquire() as db:
+                await db.execute('select pg_wal_replay_resume()')
+
+        if not await wait_for_route(replica, True, timeout):
+            print('FAIL: read only requests did not go back to the replica')
+            return False
+        print('ok: read only requests use the replica again')
+        return True
+    finally:
+        monitor.cancel()
+
+async def run(args):
+    # the monitor and the checks each hold a connection
+    pool = await asyncpg.create_pool(args.primary_dsn, min_size=1,
+                                     max_size=2)
+    read_pool = await asyncpg.create_pool(args.replica_dsn, min_size=0,
+                                          max_size=2)
+    replica = ReadReplica(pool, read_pool, args.max_lag, args.interval)
+
+    if args.check:
+        return await check(replica, args)
+
+    while True:
+        try:
+            lag = await asyncio.wait_for(replica.measure_lag(),
+                                         args.interval)
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as error:
+            print('replica unavailable: %r' % error)
+        else:
+            print('lag %8.3f s  %s' % (
+                lag, 'replica' if lag <= args.max_lag else 'primary'))
+        await asyncio.sleep(args.interval)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('primary_dsn')
+    parser.add_argument('replica_dsn')
+    parser.add_argument('--max-lag', type=float, default=1)
+    parser.add_argument('--interval', type=float, default=1)
+    parser.add_argument('--check', action='store_true',
+                        help='pause replay and check the fallback')
+    args = parser.parse_args()
+
+    try:
+        if not asyncio.get_event_loop().run_until_complete(run(args)):
+            return -1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
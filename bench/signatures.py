@@ -0,0 +1,79 @@
+# Compares signature checking on the event loop with SignatureVerifier
+# for many concurrently signed messages, as in Connection.check_signature.
+#
+#   $ python3 bench/signatures.py --messages 20000 --workers 4
+
+import argparse
+import asyncio
+import ed25519
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from borse.verify_signature import PublicKey, SignatureVerifier
+
+def make_messages(count, connections):
+    keys = []
+    for _ in range(connections):
+        private_key, public_key = ed25519.create_keypair()
+        keys.append((private_key, PublicKey(public_key.to_bytes())))
+
+    messages = []
+    for i in range(count):
+        private_key, public_key = keys[i % connections]
+        payload = json.dumps({
+            'command': 'place_order', 'id': i,
+            'params': ['BTC', 'USD', '5784.0000', '1.0000', 'Buy']})
+        signature = private_key.sign(payload.encode(), encoding='base64')
+        messages.append((public_key, payload, signature.decode()))
+    return messages
+
+async def verify_inline(messages):
+    for public_key, payload, signature in messages:
+        assert public_key.verify(payload, signature)
+
+async def verify_offloaded(messages, verifier, connections):
+    # one reader per connection, each waits for its own message to be
+    # checked before the next, like Connection.read_messages
+    async def reader(messages):
+        for public_key, payload, signature in messages:
+            assert await verifier.verify(public_key, payload, signature)
+
+    await asyncio.gather(*[reader(messages[i::connections])
+                           for i in range(connections)])
+
+def report(name, count, elapsed):
+    print('%-12s %8d messages  %8.3f s  %10.0f msg/s' % (
+        name, count, elapsed, count / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    messages = make_messages(args.messages, args.connections)
+
+    start = time.perf_counter()
+    loop.run_until_complete(verify_inline(messages))
+    report('inline', len(messages), time.perf_counter() - start)
+
+    verifier = SignatureVerifier(args.workers, args.batch_size)
+    # start the worker processes outside the measurement
+    loop.run_until_complete(verify_offloaded(messages[:args.workers],
+                                             verifier, args.workers))
+
+    start = time.perf_counter()
+    loop.run_until_complete(verify_offloaded(messages, verifier,
+                                             args.connections))
+    report('offloaded', len(messages), time.perf_counter() - start)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
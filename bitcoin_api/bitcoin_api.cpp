@@ -1,8 +1,12 @@
 #include <iostream>
+#include <mutex>
 #include <string>
 #include <string_view>
+#include <unordered_map>
+#include <vector>
 #include <bitcoin/system.hpp>
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 
 namespace py = pybind11;
 
@@ -16,29 +20,72 @@ bool is_valid_address(std::string address)
 // $ echo e171367ca589c056589c5a837b5f79b3aea61d947b5dccd5 | bx hd-new
 const std::string master_chain_code = "tpubD6NzVbkrYhZ4WVyJejvGGNMQ22hjnaJAjJJhb2TPkwWNgek3fY5CLfqF5vysK9XzGz4M7LEVJ4JUuLSVAc36yDhWWsyoVSUrc5rqKg489Mt";
 
-std::string get_address(uint32_t user_id, uint32_t chain_index)
+// Parsed once, thread safe since C++11
+const bc::system::wallet::hd_public& master_key()
 {
-	bc::system::wallet::hd_public master(master_chain_code,
-		bc::system::wallet::hd_public::testnet);
+    static const bc::system::wallet::hd_public master(master_chain_code,
+        bc::system::wallet::hd_public::testnet);
 
     BITCOIN_ASSERT(bc::system::wallet::hd_public::testnet == 70617039);
     BITCOIN_ASSERT(master);
+    return master;
+}
+
+// Derivation runs without the GIL, so the cache has its own lock
+std::mutex user_chains_mutex;
+std::unordered_map<uint32_t, bc::system::wallet::hd_public> user_chains;
+
+bc::system::wallet::hd_public user_chain(uint32_t user_id)
+{
+    {
+        std::lock_guard<std::mutex> lock(user_chains_mutex);
+        auto it = user_chains.find(user_id);
+        if (it != user_chains.end())
+            return it->second;
+    }
 
-	auto user_chain = master.derive_public(user_id);
-	auto key_chain = user_chain.derive_public(chain_index);
+    auto chain = master_key().derive_public(user_id);
+    BITCOIN_ASSERT(chain);
 
-    BITCOIN_ASSERT(user_chain);
+    std::lock_guard<std::mutex> lock(user_chains_mutex);
+    user_chains.emplace(user_id, chain);
+    return chain;
+}
+
+std::string derive_address(
+    const bc::system::wallet::hd_public& chain, uint32_t chain_index)
+{
+    auto key_chain = chain.derive_public(chain_index);
     BITCOIN_ASSERT(key_chain);
 
-	bc::system::wallet::ec_public public_key(key_chain.point());
+    bc::system::wallet::ec_public public_key(key_chain.point());
 
-	auto payaddr = public_key.to_payment_address(0x6f);
+    auto payaddr = public_key.to_payment_address(0x6f);
     return payaddr.encoded();
 }
 
+std::string get_address(uint32_t user_id, uint32_t chain_index)
+{
+    return derive_address(user_chain(user_id), chain_index);
+}
+
+std::vector<std::string> get_addresses(
+    uint32_t user_id, uint32_t start, uint32_t count)
+{
+    auto chain = user_chain(user_id);
+
+    std::vector<std::string> addresses;
+    addresses.reserve(count);
+    for (uint32_t i = 0; i < count; ++i)
+        addresses.push_back(derive_address(chain, start + i));
+    return addresses;
+}
+
 PYBIND11_MODULE(bitcoin_api, module)
 {
     module.def("is_valid_address", &is_valid_address);
-    module.def("get_address", &get_address);
+    module.def("get_address", &get_address,
+        py::call_guard<py::gil_scoped_release>());
+    module.def("get_addresses", &get_addresses,
+        py::call_guard<py::gil_scoped_release>());
 }
-
@@ -5,3 +5,7 @@ assert bitcoin_api.is_valid_address('1M4wHdskSyJAXNJpE92fS6dT3K8w1kKpCw')
 
 print(bitcoin_api.get_address(0, 110))
 
+addresses = bitcoin_api.get_addresses(0, 108, 5)
+assert len(addresses) == 5
+assert addresses[2] == bitcoin_api.get_address(0, 110)
+print(addresses)
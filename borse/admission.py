@@ -0,0 +1,115 @@
+import collections
+import time
+
+from borse.api import ResponseError
+from borse.metrics import registry
+
+class TokenBucket:
+
+    # rate tokens a second, holding at most burst
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def has(self, count):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens >= count
+
+    def take(self, count):
+        self.tokens -= count
+
+def make_bucket(limit):
+    # limit is (rate, burst), a rate of 0 means unlimited
+    if limit is None or not limit[0]:
+        return None
+    return TokenBucket(*limit)
+
+class Admission:
+
+    # users whose buckets are kept
+    user_buckets_limit = 100000
+
+    # Decides whether a request is processed or refused straight away.
+    # Requests are refused when a token bucket of the connection, of its
+    # command class on the connection or of the user is empty, and when
+    # max_requests are already being processed. Only the priority
+    # command class may use the last reserved part of max_requests.
+
+    def __init__(self, connection_limit, user_limit, class_limits,
+                 max_requests, reserved, priority_class):
+        self.connection_limit = connection_limit
+        # None when users are not limited
+        self.user_limit = user_limit if user_limit and user_limit[0] else None
+        self.class_limits = class_limits
+        self.max_requests = max_requests
+        self.shared_requests = max_requests - reserved
+        self.priority_class = priority_class
+        # requests admitted and not finished yet
+        self.active = 0
+        self.user_buckets = collections.OrderedDict()
+
+        registry.gauge('borse_active_requests',
+                       'Requests admitted and not finished yet',
+                       lambda: self.active)
+
+    def connection_buckets(self):
+        return {
+            None: make_bucket(self.connection_limit),
+            **{command_class: make_bucket(limit)
+               for command_class, limit in self.class_limits.items()}
+        }
+
+    def user_bucket(self, user_id):
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.user_buckets[user_id] = make_bucket(self.user_limit)
+            if len(self.user_buckets) > self.user_buckets_limit:
+                self.user_buckets.popitem(last=False)
+        self.user_buckets.move_to_end(user_id)
+        return bucket
+
+    def reject(self, error, command_class):
+        registry.counter('borse_requests_rejected_total',
+                         'Requests refused by admission control',
+                         error=error, command_class=command_class).inc()
+        return error
+
+    # buckets is the connection's from connection_buckets(), returns the
+    # ResponseError a request is refused with, or None once it has been
+    # admitted
+    def admit(self, buckets, user_id, request):
+        requests = request.parts()
+        command_class = requests[0].command_class
+
+        limit = self.max_requests
+        if any(part.command_class != self.priority_class
+               for part in requests):
+            limit = self.shared_requests
+        if self.active >= limit:
+            return self.reject(ResponseError.OVERLOADED, command_class)
+
+        classes = collections.Counter(part.command_class for part in requests)
+        checks = [(buckets[None], len(requests))]
+        checks.extend((buckets.get(command_class), count)
+                      for command_class, count in classes.items())
+        if user_id is not None and self.user_limit is not None:
+            checks.append((self.user_bucket(user_id), len(requests)))
+        checks = [(bucket, count) for bucket, count in checks
+                  if bucket is not None]
+
+        # a refused request takes no tokens
+        if not all(bucket.has(count) for bucket, count in checks):
+            return self.reject(ResponseError.RATE_LIMITED, command_class)
+        for bucket, count in checks:
+            bucket.take(count)
+
+        self.active += 1
+        return None
+
+    def release(self):
+        self.active -= 1
@@ -1,10 +1,17 @@
 import asyncpg
-import json
+import logging
 import re
 import borse.bitcoin_api
+import borse.config
 import borse.utility
-from passlib.apps import custom_app_context as password_context
-from passlib.hash import sha256_crypt
+from borse.encoding import RawJson
+from borse.matching_engine import Order
+from borse.metrics import registry
+from borse.password import HasherBusy
+from borse.queries import queries
+
+account_log = logging.getLogger('borse.accounts')
+order_log = logging.getLogger('borse.orders')
 
 class ResponseError:
 
@@ -15,6 +22,11 @@ class ResponseError:
     WRONG_PASSWORD = 'wrong password'
     NONUNIQUE_SESSION_KEY = 'nonunique session_key'
     INSUFFICIENT_BALANCE = 'insufficient balance'
+    BUSY = 'busy'
+    PERMISSION_DENIED = 'permission denied'
+    INVALID_SESSION = 'invalid session'
+    RATE_LIMITED = 'rate limited'
+    OVERLOADED = 'overloaded'
 
 def make_response(request_id, result):
     return {
@@ -23,6 +35,14 @@ def make_response(request_id, result):
         'result': result
     }
 
+def make_chunk_response(request_id, result):
+    return {
+        'id': request_id,
+        'error': None,
+        'result': result,
+        'more': True
+    }
+
 def make_error_response(request_id, error):
     return {
         'id': request_id,
@@ -30,60 +50,104 @@ def make_error_response(request_id, error):
         'result': None
     }
 
-async def create_account(db, request_id, username, email, password):
+# Hashing and verifying passwords wait on the process pool, so this and
+# login() hold a pooled connection only around their queries.
+async def create_account(connection, request_id,
+                         username, email, password):
     if not re.match('^[a-zA-Z0-9_.]+$', username):
         return make_error_response(request_id, ResponseError.INVALID_USERNAME)
 
-    password_hash = sha256_crypt.hash(password)
+    try:
+        password_hash = await connection.hash_password(password)
+    except HasherBusy:
+        return make_error_response(request_id, ResponseError.BUSY)
 
-    user_id = await db.fetchval('select create_user($1, $2, $3)',
-                                username, email, password_hash)
+    async with connection.acquire() as db:
+        user_id = await db.fetchval(
+            queries['create_user'], username, email, password_hash)
 
     if user_id is None:
         return make_error_response(request_id, ResponseError.DUPLICATE_USERNAME)
 
-    print('Registered user "%s" (%s)' % (username, user_id))
+    account_log.info('registered user "%s" (%s)', username, user_id)
 
     return make_response(request_id, None)
 
 async def log_password_login_attempt(db, success, auth_id, session_id):
-    await db.execute('''
-        insert into password_login_attempts (
-            was_successful, auth_id, session_id
-        ) values ($1, $2, $3)
-    ''', success, auth_id, session_id)
-
-async def login(connection, db, request_id, username, password, session_key):
-    row = await db.fetchrow('''
-        select users.user_id, auth_id, password_hash
-        from users
-        join password_authentication
-        on password_authentication.user_id=users.user_id
-        where username = $1
-    ''', username)
-    if row is None:
-        await log_password_login_attempt(db, False, None, None)
-        return make_error_response(request_id,
-                                   ResponseError.NONEXISTENT_USERNAME)
+    await db.fetchval(
+        queries['log_password_login_attempt'], success, auth_id, session_id)
 
-    user_id, auth_id, password_hash = row
+async def login(connection, request_id, username, password, session_key):
+    async with connection.acquire() as db:
+        row = await db.fetchrow(queries['password_authentication'], username)
+        if row is None:
+            await log_password_login_attempt(db, False, None, None)
+            return make_error_response(request_id,
+                                       ResponseError.NONEXISTENT_USERNAME)
 
-    if not password_context.verify(password, password_hash):
-        await log_password_login_attempt(db, False, auth_id, None)
-        return make_error_response(request_id, ResponseError.WRONG_PASSWORD)
+    user_id, auth_id, password_hash = row
 
     try:
-        session_id = await db.fetchval('''
-            select login($1, $2)
-        ''', auth_id, session_key)
-    except asyncpg.exceptions.UniqueViolationError:
-        return make_error_response(request_id,
-                                   ResponseError.NONUNIQUE_SESSION_KEY)
+        is_valid = await connection.verify_password(password, password_hash)
+    except HasherBusy:
+        return make_error_response(request_id, ResponseError.BUSY)
+
+    async with connection.acquire() as db:
+        if not is_valid:
+            await log_password_login_attempt(db, False, auth_id, None)
+            return make_error_response(request_id,
+                                       ResponseError.WRONG_PASSWORD)
+
+        try:
+            session_id = await db.fetchval(
+                queries['login'], auth_id, session_key)
+        except asyncpg.exceptions.UniqueViolationError:
+            return make_error_response(request_id,
+                                       ResponseError.NONUNIQUE_SESSION_KEY)
 
     connection.accept_authentication(user_id, session_key)
+    connection.sessions.add(session_key, user_id)
 
     return make_response(request_id, None)
 
+async def session_nonce(connection, request_id):
+    return make_response(request_id, connection.new_nonce())
+
+# Logs in with the key of an active session instead of the password, the
+# client signs the nonce from session_nonce with the session's key.
+async def resume_session(connection, db, request_id, session_key, signature):
+    nonce = connection.take_nonce()
+    if nonce is None:
+        return make_error_response(request_id, ResponseError.INVALID_SESSION)
+
+    sessions = connection.sessions
+    user_id = sessions.get(session_key)
+    if user_id is None:
+        row = await db.fetchrow(queries['active_session'], session_key)
+        if row is None or row['age'] >= sessions.lifetime:
+            return make_error_response(request_id,
+                                       ResponseError.INVALID_SESSION)
+        sessions.add(session_key, row['user_id'], row['age'])
+        user_id = row['user_id']
+
+    if not await connection.verify_signature(session_key, nonce, signature):
+        return make_error_response(request_id, ResponseError.INVALID_SESSION)
+
+    if sessions.needs_touch(session_key):
+        await db.fetchval(queries['touch_session'], session_key)
+        sessions.touch(session_key)
+
+    connection.accept_authentication(user_id, session_key)
+    return make_response(request_id, None)
+
+async def logout(connection, db, request_id):
+    session_key = connection.session_key.public_key
+    connection.end_authentication()
+    # the trigger tells every server process to drop the session
+    await db.fetchval(queries['revoke_session'], session_key)
+    connection.sessions.revoke(session_key)
+    return make_response(request_id, None)
+
 async def place_order(connection, db, request_id, user_id, base, quote,
                       price, amount, order_type):
     assert borse.utility.decimal_has_correct_precision(price, 4)
@@ -101,19 +165,20 @@ async def place_order(connection, db, request_id, user_id, base, quote,
     assert borse.utility.decimal_has_correct_precision(amount, 8)
 
     try:
-        row = await db.fetchrow('''
-            select place_order($1, $2, $3, $4, $5, $6)
-        ''', user_id, base, quote, price, amount, order_type)
+        row = await db.fetchrow(queries['place_order'], user_id,
+                                base, quote, price, amount, order_type)
     except asyncpg.exceptions.CheckViolationError:
         return make_error_response(request_id,
                                    ResponseError.INSUFFICIENT_BALANCE)
 
-    assert (deduct_currency, deduct_amount) == row[0], row[1]
-    print('Placed order for user(%s) [%s %s %s @ %s %s], deducted %s %s' % (
+    assert (deduct_currency, deduct_amount) == (
+        row['deduct_currency'], row['deduct_amount']), row
+    order_log.info(
+        'placed order for user(%s) [%s %s %s @ %s %s], deducted %s %s',
         user_id, order_type, amount, base, price, quote,
-        deduct_amount, deduct_currency))
+        deduct_amount, deduct_currency)
 
-    await connection.broadcast('ok', 'order', {
+    connection.broadcast('orders:%s/%s' % (base, quote), 'ok', 'order', {
         'amount': f'{amount:.4f}',
         'price': f'{price:.4f}',
         'order_type': order_type,
@@ -121,69 +186,101 @@ async def place_order(connection, db, request_id, user_id, base, quote,
         'quote': quote
     })
 
+    connection.submit_order(Order(
+        row['order_id'], user_id, base, quote, price, amount, order_type,
+        row['created_at']))
+
+    return make_response(request_id, None)
+
+async def fetch_orderbook(connection, request_id, base, quote, depth):
+    book = connection.level_book(base, quote)
+    return make_response(request_id, book.encoded_snapshot(depth))
+
+async def subscribe(connection, request_id, channel):
+    connection.subscribe(channel)
+
+    # a book mirror starts from the snapshot, diffs follow in order
+    kind, _, pair = channel.partition(':')
+    if kind == 'book':
+        base, quote = pair.split('/')
+        return make_response(
+            request_id, connection.level_book(base, quote).encoded_snapshot())
+
+    return make_response(request_id, None)
+
+async def unsubscribe(connection, request_id, channel):
+    connection.unsubscribe(channel)
     return make_response(request_id, None)
 
-async def fetch_orderbook(db, request_id, base, quote):
-    orderbook_json = await db.fetchval('''
-        select array_to_json(array_agg(row_to_json(result)))
-        from (
-            select
-                price::varchar,
-                remaining_amount(order_id)::varchar as amount,
-                order_type,
-                extract(epoch from created_at) as timestamp
-            from orders
-            where
-                base_currency = $1 and quote_currency = $2 and
-                status = 'Open'
-        ) as result
-    ''', base, quote)
-    assert orderbook_json is not None
-    return make_response(request_id, json.loads(orderbook_json))
-
-async def fetch_trades(db, request_id, base, quote):
-    trades_json = await db.fetchval('''
-        select array_to_json(array_agg(row_to_json(result)))
-        from (
-            select
-                trade_price::varchar as price,
-                trade_amount::varchar as amount,
-                extract(epoch from trades.created_at) as timestamp
-            from trades
-            join orders on buy_id = order_id
-            where
-                base_currency = $1 and quote_currency = $2 and
-                trades.created_at > now() - interval '24 hours'
-        ) as result
-    ''', base, quote)
-    assert trades_json is not None
-    return make_response(request_id, json.loads(trades_json))
+# rows per frame when streaming the last 24 hours of trades
+trades_chunk_size = 500
+max_trades_page = 1000
+
+async def fetch_trades_chunk(connection, base, quote, after_trade_id):
+    async with connection.acquire(True) as db:
+        records = await db.fetch(queries['trades_last_24_hours'], base,
+                                 quote, after_trade_id, trades_chunk_size)
+    return [dict(record) for record in records]
+
+async def fetch_trades(connection, request_id, base, quote):
+    # Streamed as a series of frames with 'more' set, followed by the
+    # usual response holding the last rows. Each frame is read on its
+    # own pooled connection, none is held while the client catches up.
+    rows = await fetch_trades_chunk(connection, base, quote, -1)
+    while len(rows) == trades_chunk_size:
+        next_rows = await fetch_trades_chunk(connection, base, quote,
+                                             rows[-1]['trade_id'])
+        if not next_rows:
+            break
+        await connection.send_chunk(make_chunk_response(request_id, rows))
+        rows = next_rows
+
+    return make_response(request_id, rows)
+
+async def fetch_trades_page(db, request_id, base, quote,
+                            since_trade_id, limit):
+    trades_json = await db.fetchval(
+        queries['trades_page'], base, quote, since_trade_id,
+        min(limit, max_trades_page))
+    return make_response(request_id, RawJson(trades_json))
 
 async def fetch_accounts(db, request_id, user_id):
-    accounts_json = await db.fetchval('''
-        select array_to_json(array_agg(row_to_json(result)))
-        from (
-            select currency_code, balance::varchar
-            from accounts
-            where user_id = $1
-        ) as result
-    ''', user_id)
+    accounts_json = await db.fetchval(queries['fetch_accounts'], user_id)
     assert accounts_json is not None
-    return make_response(request_id, json.loads(accounts_json))
+    return make_response(request_id, RawJson(accounts_json))
 
 async def query_ticker_info(db, request_id, base, quote):
     ticker_json = await db.fetchval(
-        'select query_ticker_info($1, $2)',
-        base, quote)
-    assert ticker_json is not None
-    ticker_data = json.loads(ticker_json)
-    assert len(ticker_data) == 1
-    ticker_data = ticker_data[0]
-    return make_response(request_id, ticker_data)
+        queries['query_ticker_info'], base, quote)
+    if ticker_json is None:
+        # no trades yet
+        return make_response(request_id, None)
+    return make_response(request_id, RawJson(ticker_json))
+
+# interval parameter of fetch_candles -> candles.resolution
+candle_resolutions = {
+    '1m': 'minute',
+    '1h': 'hour',
+    '1d': 'day'
+}
+
+max_candles = 1000
+
+async def fetch_candles(db, request_id, base, quote, interval,
+                        start_time, end_time):
+    candles_json = await db.fetchval(
+        queries['fetch_candles'], base, quote, candle_resolutions[interval],
+        start_time, end_time, max_candles)
+    return make_response(request_id, RawJson(candles_json))
 
 async def get_bitcoin_deposit_address(db, request_id, user_id):
+    address = await db.fetchval(queries['deposit_address'], user_id)
+    if address is not None:
+        return make_response(request_id, address)
+
+    # the background job has not reached this user yet
     current_chain_index = await db.fetchval(
-        'select current_bitcoin_chain_index($1)', user_id)
+        queries['current_bitcoin_chain_index'], user_id)
 
     address = borse.bitcoin_api.get_address(user_id, current_chain_index)
 
@@ -192,12 +289,17 @@ async def get_bitcoin_deposit_address(db, request_id, user_id):
 async def make_withdraw_bitcoin_request(
     db, request_id, user_id, address, amount):
     try:
-        await db.execute(
-            'select make_withdraw_bitcoin_request($1, $2, $3, $4)',
-            user_id, address, amount, 0)
+        await db.fetchval(queries['make_withdraw_bitcoin_request'],
+                          user_id, address, amount, 0)
     except asyncpg.exceptions.CheckViolationError:
         return make_error_response(request_id,
                                    ResponseError.INSUFFICIENT_BALANCE)
 
     return make_response(request_id, None)
 
+async def server_stats(request_id, user_id):
+    if user_id not in borse.config.admin_user_ids:
+        return make_error_response(request_id,
+                                   ResponseError.PERMISSION_DENIED)
+
+    return make_response(request_id, registry.snapshot())
@@ -1,75 +1,555 @@
 import asyncio
-import json
+import asyncpg
+import collections
+import contextlib
+import decimal
+import logging
+import time
+import uuid
+import weakref
 import websockets
 
+import borse.bitcoin_api
+import borse.config
+from borse.admission import Admission
 from borse.connection import Connection
+from borse.encoding import encode_event, json_to_msgpack, loads
+from borse.level_book import LevelBook
+from borse.matching_engine import fetch_open_orders
+from borse.metrics import count_buckets, fast_buckets, registry
+from borse.queries import queries
+from borse.sessions import SessionCache
+
+log = logging.getLogger(__name__)
+deposit_log = logging.getLogger('borse.deposits')
 
 class Application:
 
-    def __init__(self, pool):
+    # placement times kept for the order to trade latency histogram
+    order_times_limit = 100000
+    # An order can arrive twice: directly from place_order and through
+    # the borse_orders channel. Remember enough recent ids to drop the
+    # second copy.
+    known_order_ids_limit = 100000
+    # held by the worker that runs matching and deposits
+    leader_lock_key = 0x626f727365
+    # keeps relayed messages under the 8000 byte NOTIFY payload limit
+    relay_trades_limit = 40
+    relay_levels_limit = 60
+
+    def __init__(self, pool, password_hasher, signature_verifier=None,
+                 matching_engine=None, replica=None):
         self.pool = pool
+        # optional ReadReplica for read only requests
+        self.replica = replica
+        self.password_hasher = password_hasher
+        self.signature_verifier = signature_verifier
         self.connections = set()
+        # serializes requests with the same ordering key
+        self.ordering_locks = weakref.WeakValueDictionary()
+        # channel -> connections subscribed to it
+        self.subscribers = collections.defaultdict(set)
+        self.matching_engine = matching_engine
+        self.level_books = {}
+        self.sessions = SessionCache(borse.config.session_lifetime,
+                                     borse.config.session_cache_size)
+        max_requests = borse.config.max_concurrent_requests
+        self.admission = Admission(
+            borse.config.connection_rate_limit,
+            borse.config.user_rate_limit,
+            borse.config.command_class_rate_limits,
+            max_requests,
+            int(max_requests * borse.config.trading_reserve),
+            'trading')
+
+        self.wakeup = asyncio.Event()
+        self.orders_signalled = True
+        self.deposits_signalled = True
+        # order ids announced on the borse_orders channel
+        self.notified_order_ids = set()
+        self.known_order_ids = collections.OrderedDict()
+        self.listener = None
+
+        self.order_times = collections.OrderedDict()
+        self.trade_latency = registry.histogram(
+            'borse_order_to_trade_seconds',
+            'Time from placing an order to its first trade')
+        self.match_time = registry.histogram(
+            'borse_match_pass_seconds', 'Time spent in one matching pass')
+        self.match_trades = registry.histogram(
+            'borse_match_pass_trades', 'Trades made by one matching pass',
+            buckets=count_buckets)
+        self.broadcast_time = registry.histogram(
+            'borse_broadcast_seconds',
+            'Time spent queueing one message to its subscribers',
+            buckets=fast_buckets)
+        registry.gauge('borse_connections', 'Open websocket connections',
+                       lambda: len(self.connections))
+        registry.gauge('borse_outbox_messages',
+                       'Messages queued for all connections',
+                       lambda: sum(connection.outbox.qsize()
+                                   for connection in self.connections))
+        registry.gauge('borse_relay_queue_messages',
+                       'Messages waiting to be relayed to other workers',
+                       lambda: self.relay_queue.qsize()
+                               if self.relay_queue is not None else 0)
+
+        # With several workers, only the one holding the leader lock
+        # matches orders, processes deposits and keeps the books. The
+        # others mirror its books and every worker relays its
+        # broadcasts to the others through NOTIFY.
+        self.worker_id = uuid.uuid4().hex
+        self.is_leader = False
+        self.leader_db = None
+        self.relay_queue = None
+        if borse.config.workers > 1:
+            self.relay_queue = asyncio.Queue()
+        # book diffs relayed while setup() loads the books
+        self.loading_diffs = None
+
+    async def setup(self):
+        # Listening starts before the books are loaded, so no book diff
+        # relayed by the leader in between is lost. The diffs that
+        # arrive while loading are applied again on top of the snapshot.
+        self.loading_diffs = []
+        self.listener = await self.pool.acquire()
+        await self.listener.add_listener('borse_orders', self.on_notify)
+        await self.listener.add_listener('borse_deposits', self.on_notify)
+        await self.listener.add_listener('borse_sessions', self.on_notify)
+        if self.relay_queue is not None:
+            await self.listener.add_listener('borse_broadcast',
+                                             self.on_notify)
+            asyncio.ensure_future(self.send_relays())
+
+        async with self.pool.acquire() as db:
+            self.load_level_books(await fetch_open_orders(db))
+        for diff in self.loading_diffs:
+            self.level_book(diff['base'], diff['quote']).apply_diff(diff)
+        self.loading_diffs = None
+
+        await self.elect()
+        asyncio.ensure_future(self.populate_deposit_addresses())
+        if self.replica is not None:
+            asyncio.ensure_future(self.replica.monitor())
+
+    async def elect(self):
+        if self.is_leader:
+            try:
+                await asyncio.wait_for(self.leader_db.fetchval('select 1'),
+                                       borse.config.events_interval)
+                return
+            except (asyncpg.PostgresError, OSError, asyncio.TimeoutError):
+                # the lock went with the connection
+                log.warning('lost the leader lock')
+                await self.resign()
+                return
+
+        db = await self.pool.acquire()
+        if not await db.fetchval('select pg_try_advisory_lock($1)',
+                                 self.leader_lock_key):
+            await self.pool.release(db)
+            return
+
+        self.leader_db = db
+        await self.become_leader()
+
+    async def become_leader(self):
+        log.info('worker %s is now the leader', self.worker_id)
+
+        async with self.pool.acquire() as db:
+            orders = await fetch_open_orders(db)
+
+        # Orders placed while loading are not in the snapshot, they come
+        # back through their notifications in the next pass.
+        self.load_level_books(orders)
+        if self.matching_engine is not None:
+            self.matching_engine.clear()
+            for order in orders:
+                self.matching_engine.submit(order)
+
+        self.is_leader = True
+        self.signal_orders()
+        self.signal_deposits()
+
+    async def resign(self):
+        self.is_leader = False
+        if self.matching_engine is not None:
+            self.matching_engine.clear()
+
+        db, self.leader_db = self.leader_db, None
+        try:
+            await self.pool.release(db)
+        except (asyncpg.PostgresError, OSError):
+            pass
+
+    def load_level_books(self, orders):
+        levels = collections.defaultdict(
+            lambda: {'Buy': collections.Counter(),
+                     'Sell': collections.Counter()})
+        for order in orders:
+            levels[(order.base, order.quote)][order.order_type][
+                order.price] += order.remaining
+            self.remember_order(order)
+
+        for pair in set(levels) | set(self.level_books):
+            self.level_book(*pair).replace(levels.get(pair, {}))
 
     async def on_connect(self, websocket, path):
+        if len(self.connections) >= borse.config.max_connections:
+            log.warning('too many connections, refusing one')
+            await websocket.close(1013, 'try again later')
+            return
+
         connection = Connection(self.pool, websocket, self)
         self.connections.add(connection)
 
         try:
             await connection.start()
         except websockets.exceptions.ConnectionClosed:
-            print('Closed.')
+            log.debug('connection closed')
         finally:
             self.connections.remove(connection)
+            for channel in connection.subscriptions:
+                self.unsubscribe(connection, channel)
+
+    async def verify_signature(self, public_key, message, signature):
+        if self.signature_verifier is None:
+            return public_key.verify(message, signature)
+        return await self.signature_verifier.verify(
+            public_key, message, signature)
+
+    # a pooled connection for a request
+    def acquire(self, is_read_only):
+        if self.replica is None:
+            return self.pool.acquire()
+        return self.replica.acquire(is_read_only)
+
+    def ordering_lock(self, key):
+        if key is None:
+            return contextlib.nullcontext()
+
+        lock = self.ordering_locks.get(key)
+        if lock is None:
+            lock = self.ordering_locks[key] = asyncio.Lock()
+        return lock
+
+    def subscribe(self, connection, channel):
+        self.subscribers[channel].add(connection)
+
+    def unsubscribe(self, connection, channel):
+        subscribers = self.subscribers.get(channel)
+        if subscribers is None:
+            return
+        subscribers.discard(connection)
+        if not subscribers:
+            del self.subscribers[channel]
+
+    # message is encoded once per wire format and only queued here, the
+    # connections write it out from their own tasks
+    def broadcast(self, channel, message):
+        start = time.perf_counter()
+        packed = None
+        for connection in self.subscribers.get(channel, ()):
+            if not connection.is_binary:
+                connection.send_event(message)
+                continue
+            if packed is None:
+                packed = json_to_msgpack(message)
+            connection.send_event(packed)
+        self.broadcast_time.observe(time.perf_counter() - start)
+
+    # broadcast to the clients of every worker
+    def publish(self, channel, message):
+        self.broadcast(channel, message)
+        if self.relay_queue is not None:
+            self.relay_queue.put_nowait((channel, message))
+
+    async def send_relays(self):
+        while True:
+            # The messages being sent when this fails are lost to the
+            # other workers, the next ones go out on a new connection.
+            try:
+                await self.send_relays_on_connection()
+            except Exception:
+                log.exception('relaying broadcasts failed')
+                await asyncio.sleep(borse.config.events_interval)
+
+    async def send_relays_on_connection(self):
+        async with self.pool.acquire() as db:
+            while True:
+                relays = [await self.relay_queue.get()]
+                while not self.relay_queue.empty():
+                    relays.append(self.relay_queue.get_nowait())
+
+                payloads = []
+                for channel, message in relays:
+                    payload = ' '.join((self.worker_id, channel, message))
+                    if len(payload.encode()) >= 8000:
+                        log.warning('message too large to relay: %s',
+                                    channel)
+                        continue
+                    payloads.append(('borse_broadcast', payload))
+                await db.executemany('select pg_notify($1, $2)', payloads)
 
-    async def broadcast(self, message):
+    def on_relay(self, payload):
+        worker_id, channel, message = payload.split(' ', 2)
+        if worker_id == self.worker_id:
+            return
+
+        if channel.startswith('book:') and not self.is_leader:
+            diff = loads(message)['data']
+            self.level_book(diff['base'], diff['quote']).apply_diff(diff)
+            if self.loading_diffs is not None:
+                self.loading_diffs.append(diff)
+
+        self.broadcast(channel, message)
+
+    def level_book(self, base, quote):
+        book = self.level_books.get((base, quote))
+        if book is None:
+            book = self.level_books[(base, quote)] = LevelBook(base, quote)
+        return book
+
+    def on_notify(self, db, pid, channel, payload):
+        if channel == 'borse_orders':
+            self.notified_order_ids.add(int(payload))
+            self.signal_orders()
+        elif channel == 'borse_broadcast':
+            self.on_relay(payload)
+        elif channel == 'borse_sessions':
+            self.revoke_session(bytes.fromhex(payload))
+        else:
+            self.signal_deposits()
+
+    def revoke_session(self, session_key):
+        self.sessions.revoke(session_key)
         for connection in self.connections:
-            await connection.send(message)
+            if (connection.session_key is not None and
+                    connection.session_key.public_key == session_key):
+                connection.end_authentication()
+                asyncio.ensure_future(
+                    connection.websocket.close(1008, 'session revoked'))
+
+    def signal_orders(self):
+        self.orders_signalled = True
+        self.wakeup.set()
+
+    def signal_deposits(self):
+        self.deposits_signalled = True
+        self.wakeup.set()
 
     async def post_events(self):
+        elected_at = time.monotonic()
         while True:
-            await asyncio.sleep(1)
-            await self.match_orders()
-            await self.process_deposits()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(),
+                                       borse.config.events_interval)
+            except asyncio.TimeoutError:
+                # safety net for missed notifications
+                self.orders_signalled = self.deposits_signalled = True
+
+            # Steady order flow keeps the wakeup set, so the election
+            # and the leader's liveness check go by elapsed time.
+            if time.monotonic() - elected_at >= borse.config.events_interval:
+                elected_at = time.monotonic()
+                await self.elect()
+
+            # anything signalled from here on gets its own pass, so a
+            # burst of orders is coalesced into one or two passes
+            self.wakeup.clear()
+
+            if self.orders_signalled:
+                self.orders_signalled = False
+                await self.match_orders()
+            if self.deposits_signalled:
+                self.deposits_signalled = False
+                if self.is_leader:
+                    await self.process_deposits()
+
+    def submit_order(self, order):
+        self.order_times[order.order_id] = time.monotonic()
+        if len(self.order_times) > self.order_times_limit:
+            self.order_times.popitem(last=False)
+
+        self.add_order(order)
+        self.signal_orders()
+
+    def remember_order(self, order):
+        self.known_order_ids[order.order_id] = None
+        if len(self.known_order_ids) > self.known_order_ids_limit:
+            self.known_order_ids.popitem(last=False)
+
+    def add_order(self, order):
+        # followers get the leader's book changes instead
+        if not self.is_leader or order.order_id in self.known_order_ids:
+            return
+        self.remember_order(order)
+
+        # before matching, the engine reduces order.remaining
+        self.level_book(order.base, order.quote).update(
+            order.order_type, order.price, order.remaining)
+
+        if self.matching_engine is not None:
+            self.matching_engine.submit(order)
+
+    def apply_trade(self, base, quote, buy_id, sell_id,
+                    buy_price, sell_price, amount):
+        placed_times = [self.order_times.pop(order_id)
+                        for order_id in (buy_id, sell_id)
+                        if order_id in self.order_times]
+        if placed_times:
+            # the taker is the most recently placed order
+            self.trade_latency.observe(time.monotonic() - max(placed_times))
+
+        book = self.level_book(base, quote)
+        book.update('Buy', buy_price, -amount)
+        book.update('Sell', sell_price, -amount)
 
     async def match_orders(self):
+        order_ids, self.notified_order_ids = self.notified_order_ids, set()
+        if not self.is_leader:
+            return
+
+        order_ids = [order_id for order_id in order_ids
+                     if order_id not in self.known_order_ids]
+
+        start = time.perf_counter()
         async with self.pool.acquire() as db:
-            while await self.match_one_order(db):
-                pass
+            if order_ids:
+                for order in await fetch_open_orders(db, order_ids):
+                    self.add_order(order)
+
+            if self.matching_engine is not None:
+                trades = await self.flush_trades(db)
+            else:
+                trades = 0
+                while True:
+                    batch_trades = await self.match_order_batch(db)
+                    trades += batch_trades
+                    if batch_trades < borse.config.match_batch_size:
+                        break
+
+        self.broadcast_book_updates()
+        self.match_time.observe(time.perf_counter() - start)
+        self.match_trades.observe(trades)
+
+    async def flush_trades(self, db):
+        trades = await self.matching_engine.flush(db)
+
+        for trade in trades:
+            self.apply_trade(trade.base, trade.quote,
+                             trade.buy_id, trade.sell_id,
+                             trade.buy_price, trade.sell_price, trade.amount)
+        self.broadcast_trades([trade.event_data() for trade in trades])
+        return len(trades)
+
+    async def match_order_batch(self, db):
+        trades_data = await db.fetchval(
+            queries['match_orders'], borse.config.match_batch_size)
+        trades_data = loads(trades_data)
+
+        for trade_data in trades_data:
+            self.apply_trade(
+                trade_data['base'], trade_data['quote'],
+                trade_data.pop('buy_id'), trade_data.pop('sell_id'),
+                decimal.Decimal(trade_data.pop('buy_price')),
+                decimal.Decimal(trade_data.pop('sell_price')),
+                decimal.Decimal(trade_data['amount']))
+        self.broadcast_trades(trades_data)
+        return len(trades_data)
+
+    def broadcast_trades(self, trades_data):
+        pairs = collections.defaultdict(list)
+        for trade_data in trades_data:
+            pairs[(trade_data['base'], trade_data['quote'])].append(
+                trade_data)
 
-    async def match_one_order(self, db):
-        trade_data = await db.fetchval('select match_one_order()')
-        if trade_data is None:
-            return False
+        for (base, quote), pair_trades in pairs.items():
+            for start in range(0, len(pair_trades), self.relay_trades_limit):
+                notify_message = encode_event(
+                    'ok', 'trades',
+                    pair_trades[start:start + self.relay_trades_limit])
+                self.publish('trades:%s/%s' % (base, quote), notify_message)
 
-        trade_data = json.loads(trade_data)
-        notify_message = json.dumps({
-            'status': 'ok', 'event': 'trade', 'data': trade_data})
-        await self.broadcast(notify_message)
-        return True
+            notify_message = encode_event('ok', 'ticker', {
+                'base': base,
+                'quote': quote,
+                'last_price': pair_trades[-1]['price']
+            })
+            self.publish('ticker', notify_message)
+
+    def broadcast_book_updates(self):
+        for book in self.level_books.values():
+            for diff in book.take_changes(self.relay_levels_limit):
+                notify_message = encode_event('ok', 'book_update', diff)
+                self.publish('book:%s/%s' % (book.base, book.quote),
+                             notify_message)
+
+    async def populate_deposit_addresses(self):
+        while True:
+            if self.is_leader:
+                try:
+                    async with self.pool.acquire() as db:
+                        await self.add_deposit_addresses(db)
+                except Exception:
+                    # tried again next interval
+                    deposit_log.exception('adding deposit addresses failed')
+            await asyncio.sleep(borse.config.deposit_address_interval)
+
+    async def add_deposit_addresses(self, db):
+        lookahead = borse.config.deposit_address_lookahead
+
+        # first time for a user, carry over the chain index in use
+        for user_id, used_index in await db.fetch('''
+            select user_id, current_bitcoin_chain_index(user_id)
+            from users
+            where not exists (
+                select 1 from deposit_addresses
+                where deposit_addresses.user_id = users.user_id
+            )
+        '''):
+            await self.derive_deposit_addresses(
+                db, user_id, 0, used_index + lookahead + 1, used_index)
+
+        for user_id, last_index, used_index in await db.fetch('''
+            select
+                user_id,
+                max(chain_index),
+                coalesce(max(chain_index) filter (where is_used), 0)
+            from deposit_addresses
+            group by user_id
+            having max(chain_index) <
+                coalesce(max(chain_index) filter (where is_used), 0) + $1
+        ''', lookahead):
+            await self.derive_deposit_addresses(
+                db, user_id, last_index + 1,
+                used_index + lookahead - last_index, None)
+
+    async def derive_deposit_addresses(self, db, user_id, start, count,
+                                       used_index):
+        # the extension releases the GIL while deriving
+        addresses = await asyncio.get_event_loop().run_in_executor(
+            None, borse.bitcoin_api.get_addresses, user_id, start, count)
+
+        # marking the index in use is enough, lower ones are never handed
+        # out again and index 0 is what an unused chain starts with
+        await db.executemany('''
+            insert into deposit_addresses (
+                address, user_id, chain_index, is_used
+            ) values ($1, $2, $3, $4)
+            on conflict do nothing
+        ''', [(address, user_id, start + i,
+               used_index is not None and used_index > 0 and
+               start + i == used_index)
+              for i, address in enumerate(addresses)])
 
     async def process_deposits(self):
         async with self.pool.acquire() as db:
-            async with db.transaction():
-                async for record in db.cursor('''
-                    select account_event_id, account_id, amount
-                    from account_events
-                    where event = 'Deposit' and status = 'Open'
-                '''):
-                    await self.process_one_deposit(db, *record)
-
-    async def process_one_deposit(self, db, event_id, account_id, amount):
-        await db.execute('''
-            update accounts
-            set balance = balance + $1
-            where account_id = $2
-        ''', amount, account_id)
-
-        await db.execute('''
-            update account_events
-            set status = 'Closed'
-            where account_event_id = $1
-        ''', event_id)
-
-        print('Processed deposit event (%s) to account (%s) for %s' % (
-            event_id, account_id, amount))
-
+            while True:
+                processed = await db.fetchval(
+                    queries['process_deposits'],
+                    borse.config.deposit_batch_size)
+                if processed:
+                    deposit_log.info('processed %s deposit events', processed)
+                if processed < borse.config.deposit_batch_size:
+                    break
@@ -0,0 +1,157 @@
+import configparser
+import os
+
+# Every setting is read from the environment as BORSE_<NAME>, then from
+# the [borse] section of the file named by BORSE_CONFIG, e.g.
+#   [borse]
+#   pool_max_size = 20
+_file = configparser.ConfigParser(interpolation=None)
+_file.read(os.environ.get('BORSE_CONFIG', ''))
+
+def setting(name, default):
+    return os.environ.get('BORSE_' + name.upper(),
+                          _file.get('borse', name, fallback=default))
+
+database_dsn = setting('database_dsn', 'postgresql://kk@localhost/borse')
+
+# Connections per worker. Besides requests, the pool holds the
+# notification listener, the leader lock and, with several workers, the
+# relay sender for good. All min_size connections are opened and have
+# their statements prepared before the server accepts clients.
+pool_min_size = int(setting('pool_min_size', '10'))
+pool_max_size = int(setting('pool_max_size', '20'))
+# statements asyncpg caches per connection, keep it above the number in
+# borse.queries so they stay prepared
+statement_cache_size = int(setting('statement_cache_size', '100'))
+# seconds, 0 for no timeout
+command_timeout = float(setting('command_timeout', '0'))
+# idle connections above min_size are closed after this many seconds
+max_inactive_connection_lifetime = float(setting(
+    'max_inactive_connection_lifetime', '300'))
+
+# Optional replica for read only requests, such as market data. They go
+# to the primary while the replica is unreachable or more than
+# max_replication_lag seconds behind, checked every
+# replica_check_interval seconds.
+read_database_dsn = setting('read_database_dsn', '')
+read_pool_min_size = int(setting('read_pool_min_size', '5'))
+read_pool_max_size = int(setting('read_pool_max_size', '20'))
+max_replication_lag = float(setting('max_replication_lag', '1'))
+replica_check_interval = float(setting('replica_check_interval', '1'))
+
+# Token buckets as rate:burst in requests a second, 0 for no limit: for
+# each connection, for each user over all their connections, and for
+# each command class on a connection
+def _limit(value):
+    rate, _, burst = value.partition(':')
+    return float(rate), float(burst or rate)
+
+connection_rate_limit = _limit(setting('connection_rate_limit', '100:200'))
+user_rate_limit = _limit(setting('user_rate_limit', '200:400'))
+command_class_rate_limits = {
+    command_class: _limit(limit) for command_class, _, limit in (
+        item.partition('=') for item in setting(
+            'command_class_rate_limits',
+            'trading=50:100,market_data=20:40,auth=2:5,account=10:20'
+        ).split(','))
+    if command_class}
+
+# Requests processed at once over all connections, more are refused as
+# overloaded. The last trading_reserve of them is kept for trading
+# requests such as place_order, market data is shed first.
+max_concurrent_requests = int(setting('max_concurrent_requests',
+                                      str(2 * pool_max_size)))
+trading_reserve = float(setting('trading_reserve', '0.25'))
+
+# connections beyond this are closed as soon as they open
+max_connections = int(setting('max_connections', '10000'))
+
+# 'sql' runs match_one_order() in the database, 'memory' uses the
+# in-process engine in borse.matching_engine
+matching_engine = setting('matching_engine', 'sql')
+
+# matching and deposits run as soon as they are signalled, this is only
+# the fallback period in case a notification was missed
+events_interval = float(setting('events_interval', '10'))
+
+# upper bound on trades made by one match_orders() call in the database
+match_batch_size = int(setting('match_batch_size', '500'))
+
+# messages waiting to be written to one websocket
+outbox_size = int(setting('outbox_size', '1000'))
+# frames of streamed replies, such as fetch_trades, queued for one
+# websocket at a time, on top of outbox_size
+chunks_in_flight = int(setting('chunks_in_flight', '2'))
+# what happens when a client's outbox is full: 'drop' closes the
+# connection, 'reset' discards the queued events, keeping replies, and
+# sends fresh snapshots of the subscribed books
+slow_consumer_policy = setting('slow_consumer_policy', 'drop')
+
+# requests of one connection processed concurrently
+requests_in_flight = int(setting('requests_in_flight', '16'))
+
+# requests in one batch message
+max_batch_size = int(setting('max_batch_size', '100'))
+
+# processes doing sha256_crypt work, and how many hash or verify calls
+# may wait for them before new ones are refused as busy
+password_workers = int(setting('password_workers',
+                               str(os.cpu_count() or 1)))
+password_queue_size = int(setting('password_queue_size', '64'))
+
+# processes checking request signatures, 0 checks them on the event
+# loop, and the most signatures sent to a process at once
+signature_workers = int(setting('signature_workers', '2'))
+signature_batch_size = int(setting('signature_batch_size', '256'))
+
+# deposit events credited per transaction
+deposit_batch_size = int(setting('deposit_batch_size', '1000'))
+
+# unused deposit addresses derived ahead for every user, and how often
+# the table is topped up
+deposit_address_lookahead = int(setting('deposit_address_lookahead', '20'))
+deposit_address_interval = float(setting('deposit_address_interval', '60'))
+
+# server processes sharing the websocket port, one of them is elected to
+# run matching and deposits
+workers = int(setting('workers', '1'))
+
+# 'orjson', 'json' for the standard library, or 'auto' for orjson when
+# it is installed
+json_library = setting('json_library', 'auto')
+
+# permessage-deflate for clients that offer it, 'none' turns it off.
+# Messages under compression_min_size bytes, such as order acks, are sent
+# uncompressed. The zlib level and memory level, and the window bits
+# with 0 for the client's choice.
+compression = setting('compression', 'deflate')
+compression_min_size = int(setting('compression_min_size', '512'))
+compression_level = int(setting('compression_level', '-1'))
+compression_memory_level = int(setting('compression_memory_level', '8'))
+compression_window_bits = int(setting('compression_window_bits', '0'))
+
+# seconds a session can be resumed after it was last used, and how many
+# sessions are kept in memory
+session_lifetime = float(setting('session_lifetime', str(7 * 24 * 3600)))
+session_cache_size = int(setting('session_cache_size', '100000'))
+
+# Prometheus text metrics over HTTP, 0 disables them. Worker i of
+# several listens on metrics_port + i.
+metrics_port = int(setting('metrics_port', '0'))
+metrics_host = setting('metrics_host', '127.0.0.1')
+
+# user ids allowed to run admin commands such as server_stats
+admin_user_ids = {int(user_id) for user_id in
+                  setting('admin_user_ids', '').split(',')
+                  if user_id}
+
+# Level of the borse loggers, 'text' or 'json' lines, and the fraction
+# of records kept for high volume loggers such as
+# BORSE_LOG_SAMPLE_RATES=borse.orders=0.01,borse.requests=0.001
+log_level = setting('log_level', 'INFO')
+log_format = setting('log_format', 'text')
+log_sample_rates = {
+    name: float(rate) for name, _, rate in (
+        item.partition('=') for item in setting(
+            'log_sample_rates', 'borse.orders=0.01').split(','))
+    if name}
@@ -1,29 +1,67 @@
-import json
+import asyncio
+import functools
+import logging
+import secrets
+import time
 
-from borse.requests import request_types, authenticated_request_types
-from borse.utility import eprint
+import borse.config
+from borse.api import make_error_response
+from borse.encoding import decode, encode_event, encode_response, pack
+from borse.metrics import fast_buckets, registry
+from borse.requests import (BatchRequest, request_types,
+                            authenticated_request_types)
 from borse.verify_signature import PublicKey
+from borse.wire import MSGPACK_PROTOCOL
+
+# Raw messages are never logged, they carry passwords
+log = logging.getLogger(__name__)
+request_log = logging.getLogger('borse.requests')
+
+pool_wait = registry.histogram(
+    'borse_pool_acquire_seconds',
+    'Time a request waited for a database connection')
+signature_time = registry.histogram(
+    'borse_signature_verify_seconds', 'Time spent checking a signature',
+    buckets=fast_buckets)
+
+# commands are checked before they get here, so this stays small
+@functools.lru_cache(maxsize=None)
+def request_metrics(command):
+    return (registry.counter('borse_requests_total', 'Requests processed',
+                             command=command),
+            registry.counter('borse_request_errors_total',
+                             'Requests answered with an error',
+                             command=command),
+            registry.histogram('borse_request_seconds',
+                               'Time spent processing a request',
+                               command=command))
+
+class StreamAborted(Exception):
+    pass
 
 def json_parser(message, spec):
     try:
-        object_ = json.loads(message)
-    except json.JSONDecodeError:
-        eprint('invalid json for:', message)
+        object_ = decode(message)
+    except ValueError:
+        log.warning('undecodable message')
         return None
 
+    return check_object(object_, spec, message)
+
+def check_object(object_, spec, message):
     if not isinstance(object_, dict):
-        eprint('invalid json type for:', message)
+        log.warning('invalid message type')
         return None
 
     for key, type_ in spec:
         try:
             value = object_[key]
         except KeyError:
-            eprint('missing key for:', message)
+            log.warning('missing key: %s', key)
             return None
 
         if not isinstance(value, type_):
-            eprint('poorly formed message for:', message)
+            log.warning('poorly formed message, key: %s', key)
             return None
 
     return object_
@@ -36,38 +74,285 @@ class Connection:
         self.parent = parent
         self.user_id = None
         self.session_key = None
+        self.sessions = parent.sessions
+        # handed out by session_nonce, good for one resume_session
+        self.nonce = None
+        self.subscriptions = set()
+        # (kind, message) of replies, events and chunks of streamed
+        # replies, written out by write_messages()
+        self.outbox = asyncio.Queue(borse.config.outbox_size)
+        # chunks queued, a stream waits for the client instead of
+        # filling the outbox
+        self.chunks = asyncio.Semaphore(borse.config.chunks_in_flight)
+        self.is_dropped = False
+        # requests being processed concurrently
+        self.tasks = set()
+        self.in_flight = asyncio.Semaphore(borse.config.requests_in_flight)
+        self.admission = parent.admission
+        self.buckets = self.admission.connection_buckets()
+        # replies and events are sent as MessagePack instead of JSON
+        self.is_binary = websocket.subprotocol == MSGPACK_PROTOCOL
+        # task running write_messages(), set by start()
+        self.writer = None
+
+    def broadcast(self, channel, status, event, data):
+        notify_message = encode_event(status, event, data)
+        self.parent.publish(channel, notify_message)
+
+    def submit_order(self, order):
+        self.parent.submit_order(order)
+
+    def level_book(self, base, quote):
+        return self.parent.level_book(base, quote)
 
-    async def broadcast(self, status, event, data):
-        notify_message = json.dumps({
-            'status': status, 'event': event, 'data': data})
-        await self.parent.broadcast(notify_message)
+    # for requests that need a connection only part of the time
+    def acquire(self, is_read_only=False):
+        return self.parent.acquire(is_read_only)
+
+    async def hash_password(self, password):
+        return await self.parent.password_hasher.hash(password)
+
+    async def verify_password(self, password, password_hash):
+        return await self.parent.password_hasher.verify(
+            password, password_hash)
+
+    def subscribe(self, channel):
+        self.subscriptions.add(channel)
+        self.parent.subscribe(self, channel)
+
+    def unsubscribe(self, channel):
+        self.subscriptions.discard(channel)
+        self.parent.unsubscribe(self, channel)
 
     async def start(self):
-        async for message in self.websocket:
-            print('Received:', message)
+        writer = self.writer = asyncio.ensure_future(self.write_messages())
+        try:
+            await self.read_messages()
+        finally:
+            # replies to the requests left can no longer be delivered
+            # once the socket is gone, and the writer stops on that
+            if self.websocket.closed:
+                self.cancel_tasks()
+            while self.tasks and not writer.done():
+                await asyncio.wait(self.tasks | {writer},
+                                   return_when=asyncio.FIRST_COMPLETED)
+            self.cancel_tasks()
+            if self.tasks:
+                await asyncio.wait(self.tasks)
+
+            # deliver the last replies, unless the socket is gone
+            flushed = asyncio.ensure_future(self.outbox.join())
+            await asyncio.wait([flushed, writer],
+                               return_when=asyncio.FIRST_COMPLETED)
+            flushed.cancel()
+            writer.cancel()
 
-            request = self.read_request(message)
+    async def read_messages(self):
+        async for message in self.websocket:
+            request = await self.read_request(message)
             if request is None:
                 return
 
-            async with self.pool.acquire() as db:
-                response = await request.process(self, db)
+            # Later messages may depend on what this request changes,
+            # such as login setting the key used to check signatures.
+            if request.is_barrier:
+                if self.tasks:
+                    await asyncio.wait(self.tasks)
+            else:
+                await self.in_flight.acquire()
+
+            # nothing is awaited from here until the request holds its
+            # slot in a way that gives it back, even when cancelled
+            error = self.admission.admit(self.buckets, self.user_id, request)
+            if error is not None:
+                if not request.is_barrier:
+                    self.in_flight.release()
+                self.refuse(request, error)
+                continue
+
+            if request.is_barrier:
+                try:
+                    await self.process_request(request)
+                finally:
+                    self.admission.release()
+                continue
+
+            task = asyncio.ensure_future(self.process_request(request))
+            self.tasks.add(task)
+            task.add_done_callback(self.on_request_done)
+
+    def refuse(self, request, error):
+        if isinstance(request, BatchRequest):
+            response = [make_error_response(part.id, error)
+                        for part in request.requests]
+        else:
+            response = make_error_response(request.id, error)
+        self.send(self.encode_response(response))
+
+    def cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def on_request_done(self, task):
+        self.tasks.discard(task)
+        self.in_flight.release()
+        self.admission.release()
+
+    async def process_request(self, request):
+        requests, errors, duration = request_metrics(request.command)
+        start = time.perf_counter()
+        try:
+            # tasks start in arrival order, so requests with the same
+            # ordering key get the lock in the order they were sent
+            async with self.parent.ordering_lock(request.ordering_key(self)):
+                if request.needs_db:
+                    acquire_start = time.perf_counter()
+                    async with self.parent.acquire(request.is_read_only) as db:
+                        pool_wait.observe(time.perf_counter() - acquire_start)
+                        response = await request.process(self, db)
+                else:
+                    response = await request.process(self, None)
+        except StreamAborted:
+            log.debug('connection closed during %s #%s', request.command,
+                      request.id)
+            return
+        except Exception:
+            log.exception('request failed: %s #%s', request.command,
+                          request.id)
+            errors.inc()
+            await self.websocket.close(1011, 'internal error')
+            return
+
+        requests.inc()
+        duration.observe(time.perf_counter() - start)
+        if isinstance(response, dict) and response['error'] is not None:
+            errors.inc()
+
+        self.send(self.encode_response(response))
+
+    def encode_response(self, response):
+        if self.is_binary:
+            return pack(response)
+        return encode_response(response)
+
+    def encode_event(self, status, event, data):
+        if self.is_binary:
+            return pack({'status': status, 'event': event, 'data': data})
+        return encode_event(status, event, data)
+
+    async def write_messages(self):
+        while True:
+            kind, message = await self.outbox.get()
+            await self.websocket.send(message)
+            self.outbox.task_done()
+            if kind == 'chunk':
+                self.chunks.release()
+
+    # Part of a streamed reply, waits until fewer than chunks_in_flight
+    # chunks are queued instead of treating a full outbox as a slow
+    # consumer. Raises StreamAborted once nothing drains the outbox
+    # anymore, which ends the request.
+    async def send_chunk(self, response):
+        await self.wait_for_writer(self.chunks.acquire())
+        try:
+            await self.wait_for_writer(self.outbox.put(
+                ('chunk', self.encode_response(response))))
+        except StreamAborted:
+            self.chunks.release()
+            raise
+
+    async def wait_for_writer(self, awaitable):
+        if self.is_dropped or self.writer.done():
+            raise StreamAborted()
+
+        future = asyncio.ensure_future(awaitable)
+        await asyncio.wait([future, self.writer],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not future.done():
+            future.cancel()
+            raise StreamAborted()
+
+    def send(self, message, kind='reply'):
+        if self.is_dropped:
+            return
+
+        try:
+            self.outbox.put_nowait((kind, message))
+        except asyncio.QueueFull:
+            self.on_slow_consumer(kind, message)
+
+    def send_event(self, message):
+        self.send(message, 'event')
+
+    def on_slow_consumer(self, kind, message):
+        if (borse.config.slow_consumer_policy == 'reset' and
+                self.reset_events(kind, message)):
+            return
 
-            message = json.dumps(response)
-            await self.send(message)
+        log.warning('outbox full, dropping connection of user %s',
+                    self.user_id)
+        self.is_dropped = True
+        asyncio.ensure_future(self.websocket.close(1008, 'slow consumer'))
 
-    async def send(self, message):
-        await self.websocket.send(message)
+    # Drops the queued events and tells the client to start over, replies
+    # stay queued. Returns False when the outbox has no room for that.
+    def reset_events(self, kind, message):
+        replies = []
+        while not self.outbox.empty():
+            item = self.outbox.get_nowait()
+            self.outbox.task_done()
+            if item[0] != 'event':
+                replies.append(item)
+        for item in replies:
+            self.outbox.put_nowait(item)
+
+        events = [self.encode_event('ok', 'reset', None)]
+        # book mirrors are now stale, send fresh snapshots
+        for channel in self.subscriptions:
+            kind, _, pair = channel.partition(':')
+            if kind == 'book':
+                base, quote = pair.split('/')
+                events.append(self.encode_event(
+                    'ok', 'book_snapshot',
+                    self.level_book(base, quote).encoded_snapshot()))
+
+        # the message that did not fit is kept when it is a reply
+        room = self.outbox.maxsize - self.outbox.qsize()
+        if room < len(events) + (kind != 'event'):
+            return False
+
+        log.warning('outbox full, resetting subscriptions for user %s',
+                    self.user_id)
+        if kind != 'event':
+            self.outbox.put_nowait((kind, message))
+        for event in events:
+            self.outbox.put_nowait(('event', event))
+        return True
 
     def accept_authentication(self, user_id, session_key):
         self.user_id = user_id
         self.session_key = PublicKey(session_key)
 
-    def read_request(self, message):
-        payload = self.check_signature(message)
+    def end_authentication(self):
+        self.user_id = None
+        self.session_key = None
+
+    def new_nonce(self):
+        self.nonce = secrets.token_hex(32)
+        return self.nonce
+
+    def take_nonce(self):
+        nonce, self.nonce = self.nonce, None
+        return nonce
+
+    async def verify_signature(self, public_key, message, signature):
+        return await self.parent.verify_signature(
+            PublicKey(public_key), message, signature)
+
+    async def read_request(self, message):
+        payload = await self.check_signature(message)
         if payload is None:
             return None
-        print('Payload:', payload)
 
         request = self.parse_request(payload)
         if request is None:
@@ -75,26 +360,60 @@ class Connection:
 
         return request
 
-    def check_signature(self, message):
+    async def check_signature(self, message):
         if self.session_key is None:
             return message
 
         header = json_parser(message, [
-            ('payload', str), ('signature', str)])
+            ('payload', (str, bytes)), ('signature', str)])
         if header is None:
             return None
 
         payload, signature = header['payload'], header['signature']
 
-        if not self.session_key.verify(payload, signature):
-            eprint('invalid signature for:', message)
+        start = time.perf_counter()
+        is_valid = await self.parent.verify_signature(
+            self.session_key, payload, signature)
+        signature_time.observe(time.perf_counter() - start)
+        if not is_valid:
+            log.warning('invalid signature from user %s', self.user_id)
             return None
 
         return payload
 
     def parse_request(self, message):
-        request = json_parser(message, [
-            ('command', str), ('id', int), ('params', list)])
+        try:
+            object_ = decode(message)
+        except ValueError:
+            log.warning('undecodable message')
+            return None
+
+        if isinstance(object_, list):
+            return self.parse_batch(object_, message)
+
+        return self.parse_request_object(object_, message)
+
+    def parse_batch(self, objects, message):
+        if not objects or len(objects) > borse.config.max_batch_size:
+            log.warning('invalid batch size: %s', len(objects))
+            return None
+
+        requests = []
+        for object_ in objects:
+            request = self.parse_request_object(object_, message)
+            if request is None:
+                return None
+            if request.is_barrier or request.acquires_db:
+                log.warning('command not allowed in batch: %s',
+                            request.command)
+                return None
+            requests.append(request)
+
+        return BatchRequest(requests)
+
+    def parse_request_object(self, object_, message):
+        request = check_object(object_, [
+            ('command', str), ('id', int), ('params', list)], message)
         if request is None:
             return None
 
@@ -104,12 +423,12 @@ class Connection:
             return self.make_request_object(request, request_types, message)
         elif command in authenticated_request_types:
             if self.session_key is None:
-                eprint('command requires authentication:', message)
+                log.warning('command requires authentication: %s', command)
                 return None
             return self.make_request_object(
                 request, authenticated_request_types, message)
 
-        eprint('non-existent command for:', message)
+        log.warning('non-existent command: %.32r', command)
         return None
 
     def make_request_object(self, request, request_types, message):
@@ -118,8 +437,11 @@ class Connection:
 
         request_object = request_types[command](command, ident)
         if not request_object.unpack(params):
-            eprint('poorly formed parameters for:', request)
+            log.warning('poorly formed parameters for: %s #%s',
+                        command, ident)
             return None
 
+        request_log.debug('%s #%s from user %s', command, ident, self.user_id)
+
         return request_object
 
@@ -0,0 +1,79 @@
+import json
+
+import borse.config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# JSON used for every message. BORSE_JSON_LIBRARY picks 'orjson', or
+# 'json' for the standard library, the default uses orjson if it is
+# installed.
+
+orjson = None
+if borse.config.json_library in ('auto', 'orjson'):
+    try:
+        import orjson
+    except ImportError:
+        if borse.config.json_library == 'orjson':
+            raise
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(object_):
+        # websockets sends str as a text frame
+        return orjson.dumps(
+            object_, option=orjson.OPT_NON_STR_KEYS).decode()
+else:
+    loads = json.loads
+    dumps = json.dumps
+
+class RawJson:
+
+    # JSON text made elsewhere, such as by Postgres, spliced as it is
+    # into the response instead of being decoded and encoded again
+    def __init__(self, text):
+        self.text = text
+
+def encode_event(status, event, data):
+    if not isinstance(data, RawJson):
+        return dumps({'status': status, 'event': event, 'data': data})
+
+    return '{"status":%s,"event":%s,"data":%s}' % (
+        dumps(status), dumps(event), data.text)
+
+def encode_response(response):
+    if isinstance(response, list):
+        return '[%s]' % ','.join(encode_response(item) for item in response)
+
+    result = response['result']
+    if not isinstance(result, RawJson):
+        return dumps(response)
+
+    return '{"id":%s,"error":%s,"result":%s%s}' % (
+        dumps(response['id']), dumps(response['error']), result.text,
+        ',"more":true' if response.get('more') else '')
+
+def _unpack_raw_json(object_):
+    if isinstance(object_, RawJson):
+        return loads(object_.text)
+    raise TypeError('cannot pack %r' % object_)
+
+# The binary wire format, the same messages in MessagePack
+
+def pack(object_):
+    return msgpack.packb(object_, default=_unpack_raw_json)
+
+def json_to_msgpack(message):
+    return pack(loads(message))
+
+# binary frames are MessagePack and text frames JSON, whatever the
+# connection's subprotocol
+def decode(message):
+    if isinstance(message, str):
+        return loads(message)
+    if msgpack is None:
+        raise ValueError('binary messages need msgpack installed')
+    return msgpack.unpackb(message)
@@ -0,0 +1,109 @@
+import decimal
+
+from borse.encoding import RawJson, dumps
+
+class LevelBook:
+
+    # distinct depths cached at once
+    encoded_snapshots_limit = 16
+
+    def __init__(self, base, quote):
+        self.base = base
+        self.quote = quote
+        # order_type -> {price: total remaining amount}
+        self.levels = {'Buy': {}, 'Sell': {}}
+        self.sequence = 0
+        # (order_type, price) touched since the last take_changes()
+        self.changes = set()
+        # depth -> RawJson of the snapshot, until the book changes
+        self.encoded_snapshots = {}
+
+    def update(self, order_type, price, delta):
+        levels = self.levels[order_type]
+        amount = levels.get(price, 0) + delta
+        if amount > 0:
+            levels[price] = amount
+        else:
+            levels.pop(price, None)
+        self.changes.add((order_type, price))
+        self.encoded_snapshots.clear()
+
+    def _side(self, order_type, depth=None):
+        prices = sorted(self.levels[order_type],
+                        reverse=(order_type == 'Buy'))
+        if depth is not None:
+            prices = prices[:depth]
+        return [self._level(order_type, price) for price in prices]
+
+    def _level(self, order_type, price):
+        amount = self.levels[order_type].get(price, 0)
+        return [f'{price:.4f}', f'{amount:.4f}']
+
+    def snapshot(self, depth=None):
+        return {
+            'base': self.base,
+            'quote': self.quote,
+            'sequence': self.sequence,
+            'bids': self._side('Buy', depth),
+            'asks': self._side('Sell', depth)
+        }
+
+    # the same snapshot is usually asked for many times between changes
+    def encoded_snapshot(self, depth=None):
+        encoded = self.encoded_snapshots.get(depth)
+        if encoded is None:
+            encoded = RawJson(dumps(self.snapshot(depth)))
+            if len(self.encoded_snapshots) < self.encoded_snapshots_limit:
+                self.encoded_snapshots[depth] = encoded
+        return encoded
+
+    # Returns the levels changed since the last call as diffs of at most
+    # max_levels levels each, an amount of zero means the level was
+    # removed. Clients apply these on top of a snapshot with a lower
+    # sequence number.
+    def take_changes(self, max_levels):
+        changes = sorted(self.changes)
+        self.changes = set()
+        if changes:
+            self.encoded_snapshots.clear()
+
+        diffs = []
+        for start in range(0, len(changes), max_levels):
+            self.sequence += 1
+            diff = {
+                'base': self.base,
+                'quote': self.quote,
+                'sequence': self.sequence,
+                'bids': [],
+                'asks': []
+            }
+            for order_type, price in changes[start:start + max_levels]:
+                side = 'bids' if order_type == 'Buy' else 'asks'
+                diff[side].append(self._level(order_type, price))
+            diffs.append(diff)
+        return diffs
+
+    # levels is {order_type: {price: amount}} of the whole book, only
+    # the levels that differ are recorded as changes
+    def replace(self, levels):
+        for order_type in ('Buy', 'Sell'):
+            old_levels = self.levels[order_type]
+            new_levels = levels.get(order_type, {})
+            for price in set(old_levels) | set(new_levels):
+                if old_levels.get(price) != new_levels.get(price):
+                    self.changes.add((order_type, price))
+            self.levels[order_type] = dict(new_levels)
+        self.encoded_snapshots.clear()
+
+    # mirror a diff made by another process' book
+    def apply_diff(self, diff):
+        for side, order_type in (('bids', 'Buy'), ('asks', 'Sell')):
+            levels = self.levels[order_type]
+            for price, amount in diff[side]:
+                price, amount = decimal.Decimal(price), decimal.Decimal(amount)
+                if amount > 0:
+                    levels[price] = amount
+                else:
+                    levels.pop(price, None)
+        self.sequence = diff['sequence']
+        self.encoded_snapshots.clear()
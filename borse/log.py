@@ -0,0 +1,80 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+import borse.config
+
+# Records are only put on a queue by the event loop, a background thread
+# does the formatting into lines and the blocking writes.
+
+class SampleFilter(logging.Filter):
+
+    # rates is logger name -> fraction of records kept, a rate also
+    # applies to the loggers below it
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition('.')[0]
+        return True
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage()
+        }
+        if record.exc_text:
+            line['exception'] = record.exc_text
+        return json.dumps(line)
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    # the stock handler formats the message here, on the event loop,
+    # leave that to the listener thread. Arguments are passed as they
+    # are, so only log values that are not changed afterwards.
+    def prepare(self, record):
+        if record.exc_info:
+            # the frames may be gone by the time the thread gets to it
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    if borse.config.log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s[%(process)d]: %(message)s')
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(SampleFilter(borse.config.log_sample_rates))
+
+    # a forked worker inherits the handlers but not the listener thread
+    logger = logging.getLogger('borse')
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    logger.setLevel(borse.config.log_level)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    listener.start()
+    return listener
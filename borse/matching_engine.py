@@ -0,0 +1,176 @@
+import bisect
+import collections
+
+from borse.queries import queries
+
+class Order:
+
+    def __init__(self, order_id, user_id, base, quote, price, amount,
+                 order_type, created_at):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.base = base
+        self.quote = quote
+        self.price = price
+        self.remaining = amount
+        self.order_type = order_type
+        self.created_at = created_at
+
+class Trade:
+
+    def __init__(self, buy, sell, price, amount):
+        self.buy_id = buy.order_id
+        self.buy_price = buy.price
+        self.sell_id = sell.order_id
+        self.sell_price = sell.price
+        self.base = buy.base
+        self.quote = buy.quote
+        self.price = price
+        self.amount = amount
+
+    def event_data(self):
+        return {
+            'price': f'{self.price:.4f}',
+            'amount': f'{self.amount:.4f}',
+            'base': self.base,
+            'quote': self.quote
+        }
+
+# Same rule as match_one_order() in trade_engine.sql
+def trade_price(buy, sell):
+    if sell.created_at < buy.created_at:
+        return max(buy.price, sell.price)
+    else:
+        return min(buy.price, sell.price)
+
+class BookSide:
+
+    def __init__(self, is_buy):
+        self.is_buy = is_buy
+        # price -> FIFO queue of resting orders
+        self.levels = {}
+        # sorted ascending
+        self.prices = []
+
+    def best_price(self):
+        if not self.prices:
+            return None
+        return self.prices[-1] if self.is_buy else self.prices[0]
+
+    def crosses(self, order):
+        best = self.best_price()
+        if best is None:
+            return False
+        if self.is_buy:
+            return best >= order.price
+        return best <= order.price
+
+    def add(self, order):
+        level = self.levels.get(order.price)
+        if level is None:
+            level = self.levels[order.price] = collections.deque()
+            bisect.insort(self.prices, order.price)
+        level.append(order)
+
+    def front(self):
+        return self.levels[self.best_price()][0]
+
+    def pop_front(self):
+        price = self.best_price()
+        level = self.levels[price]
+        level.popleft()
+        if not level:
+            del self.levels[price]
+            self.prices.remove(price)
+
+class OrderBook:
+
+    def __init__(self, base, quote):
+        self.base = base
+        self.quote = quote
+        self.bids = BookSide(True)
+        self.asks = BookSide(False)
+
+    def match(self, order):
+        if order.order_type == 'Buy':
+            own, opposite = self.bids, self.asks
+        else:
+            own, opposite = self.asks, self.bids
+
+        trades = []
+        while order.remaining > 0 and opposite.crosses(order):
+            maker = opposite.front()
+            amount = min(order.remaining, maker.remaining)
+
+            if order.order_type == 'Buy':
+                buy, sell = order, maker
+            else:
+                buy, sell = maker, order
+
+            trades.append(Trade(buy, sell, trade_price(buy, sell), amount))
+
+            order.remaining -= amount
+            maker.remaining -= amount
+            if maker.remaining == 0:
+                opposite.pop_front()
+
+        if order.remaining > 0:
+            own.add(order)
+
+        return trades
+
+async def fetch_open_orders(db, order_ids=None):
+    records = await db.fetch(queries['open_orders'], order_ids)
+    return [Order(*record) for record in records]
+
+class MatchingEngine:
+
+    # The engine is loaded from the database while new orders keep
+    # arriving, so one can be submitted twice. Remember enough recent
+    # ids to drop the second copy.
+    recent_order_ids_limit = 100000
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.books = {}
+        # trades matched in memory but not yet written to the database
+        self.pending_trades = []
+        self.recent_order_ids = collections.OrderedDict()
+
+    def book(self, base, quote):
+        book = self.books.get((base, quote))
+        if book is None:
+            book = self.books[(base, quote)] = OrderBook(base, quote)
+        return book
+
+    def submit(self, order):
+        if order.order_id in self.recent_order_ids:
+            return []
+        self.recent_order_ids[order.order_id] = None
+        if len(self.recent_order_ids) > self.recent_order_ids_limit:
+            self.recent_order_ids.popitem(last=False)
+
+        trades = self.book(order.base, order.quote).match(order)
+        self.pending_trades.extend(trades)
+        return trades
+
+    async def flush(self, db):
+        if not self.pending_trades:
+            return []
+
+        trades = self.pending_trades
+        self.pending_trades = []
+
+        try:
+            async with db.transaction():
+                await db.executemany(queries['record_trade'], [
+                    (trade.buy_id, trade.sell_id, trade.price, trade.amount)
+                    for trade in trades])
+        except Exception:
+            # keep them for the next flush
+            self.pending_trades = trades + self.pending_trades
+            raise
+
+        return trades
@@ -0,0 +1,153 @@
+import asyncio
+import bisect
+
+default_buckets = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# for work done without leaving the event loop
+fast_buckets = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01)
+
+count_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value)
+                             for key, value in sorted(labels.items()))
+
+class Histogram:
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help, labels=None, buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = buckets
+        # one extra slot for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self):
+        bounds = [str(bucket) for bucket in self.buckets] + ['+Inf']
+        rows = []
+        cumulative = 0
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            rows.append('%s_bucket%s %s' % (
+                self.name, _format_labels(self.labels, le=bound), cumulative))
+        rows.append('%s_sum%s %s' % (
+            self.name, _format_labels(self.labels), self.sum))
+        rows.append('%s_count%s %s' % (
+            self.name, _format_labels(self.labels), self.count))
+        return rows
+
+    def value(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip(
+                    [str(bucket) for bucket in self.buckets] + ['+Inf'],
+                    self.counts))}
+
+class Counter:
+
+    type_name = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.count = 0
+
+    def inc(self, amount=1):
+        self.count += amount
+
+    def render(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labels),
+                             self.count)]
+
+    def value(self):
+        return self.count
+
+class Gauge:
+
+    type_name = 'gauge'
+
+    # the value is read from function when scraped, nothing is spent on
+    # the hot path
+    def __init__(self, name, help, function, labels=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = labels or {}
+
+    def render(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labels),
+                             self.function())]
+
+    def value(self):
+        return self.function()
+
+class Registry:
+
+    def __init__(self):
+        # (name, sorted labels) -> metric
+        self.metrics = {}
+
+    def _get(self, class_, name, help, labels, *args, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = class_(
+                name, help, *args, labels=labels, **kwargs)
+        return metric
+
+    def histogram(self, name, help, buckets=default_buckets, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def counter(self, name, help, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, function, **labels):
+        return self._get(Gauge, name, help, labels, function)
+
+    def render(self):
+        rows = []
+        described = set()
+        for (name, _), metric in sorted(self.metrics.items()):
+            if name not in described:
+                described.add(name)
+                rows.append('# HELP %s %s' % (name, metric.help))
+                rows.append('# TYPE %s %s' % (name, metric.type_name))
+            rows.extend(metric.render())
+        return '\n'.join(rows) + '\n'
+
+    def snapshot(self):
+        result = {}
+        for (name, labels), metric in sorted(self.metrics.items()):
+            result[name + _format_labels(dict(labels))] = metric.value()
+        return result
+
+registry = Registry()
+
+async def serve_metrics(host, port):
+    async def handle(reader, writer):
+        # any request gets the metrics, this is only meant for a scraper
+        # on the local machine
+        await reader.readline()
+        body = registry.render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,64 @@
+import asyncio
+import concurrent.futures
+import time
+from passlib.apps import custom_app_context as password_context
+from passlib.hash import sha256_crypt
+
+from borse.metrics import registry
+
+# These run in the worker processes. time.monotonic() is system wide
+# on Linux, so the timestamps compare with the ones in the server.
+
+def _hash(password):
+    started = time.monotonic()
+    password_hash = sha256_crypt.hash(password)
+    return password_hash, started, time.monotonic()
+
+def _verify(password, password_hash):
+    started = time.monotonic()
+    is_valid = password_context.verify(password, password_hash)
+    return is_valid, started, time.monotonic()
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+
+    def __init__(self, workers, queue_size):
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        self.queue_size = queue_size
+        # submitted and not finished yet
+        self.pending = 0
+
+        self.queue_wait = registry.histogram(
+            'borse_password_queue_wait_seconds',
+            'Time a password hash or verify waited for a worker')
+        self.hash_time = registry.histogram(
+            'borse_password_hash_seconds',
+            'Time spent hashing or verifying a password')
+        registry.gauge('borse_password_pending',
+                       'Password hash or verify calls not finished yet',
+                       lambda: self.pending)
+
+    async def _run(self, function, *args):
+        if self.pending >= self.queue_size:
+            raise HasherBusy()
+
+        self.pending += 1
+        submitted = time.monotonic()
+        try:
+            result, started, finished = \
+                await asyncio.get_event_loop().run_in_executor(
+                    self.executor, function, *args)
+        finally:
+            self.pending -= 1
+
+        self.queue_wait.observe(started - submitted)
+        self.hash_time.observe(finished - started)
+        return result
+
+    async def hash(self, password):
+        return await self._run(_hash, password)
+
+    async def verify(self, password, password_hash):
+        return await self._run(_verify, password, password_hash)
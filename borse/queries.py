@@ -0,0 +1,146 @@
+# The SQL the server runs, by name. Use them as
+#   await db.fetchval(queries['create_user'], username, email, hash)
+# asyncpg keeps them prepared in each connection's statement cache, so
+# requests skip the parse and plan round trip.
+
+trade_columns = '''
+    trade_id,
+    trade_price::varchar as price,
+    trade_amount::varchar as amount,
+    extract(epoch from trades.created_at)::float8 as timestamp
+'''
+
+queries = {
+    'create_user': '''
+        select create_user($1, $2, $3)
+    ''',
+    'log_password_login_attempt': '''
+        insert into password_login_attempts (
+            was_successful, auth_id, session_id
+        ) values ($1, $2, $3)
+    ''',
+    'password_authentication': '''
+        select users.user_id, auth_id, password_hash
+        from users
+        join password_authentication
+        on password_authentication.user_id=users.user_id
+        where username = $1
+    ''',
+    'login': '''
+        select login($1, $2)
+    ''',
+    'active_session': '''
+        select
+            user_id,
+            extract(epoch from now() - last_updated_at)::float8 as age
+        from sessions
+        where session_key = $1 and is_active
+    ''',
+    'touch_session': '''
+        update sessions set last_updated_at = now()
+        where session_key = $1
+    ''',
+    'revoke_session': '''
+        update sessions set is_active = false
+        where session_key = $1 and is_active
+    ''',
+    'place_order': '''
+        select * from place_order($1, $2, $3, $4, $5, $6)
+    ''',
+    'trades_last_24_hours': '''
+        select ''' + trade_columns + '''
+        from trades
+        join orders on buy_id = order_id
+        where
+            base_currency = $1 and quote_currency = $2 and
+            trades.created_at > now() - interval '24 hours' and
+            trade_id > $3
+        order by trade_id
+        limit $4
+    ''',
+    'trades_page': '''
+        select coalesce(json_agg(page order by trade_id), '[]')
+        from (
+            select ''' + trade_columns + '''
+            from trades
+            join orders on buy_id = order_id
+            where
+                base_currency = $1 and quote_currency = $2 and
+                trade_id > $3
+            order by trade_id
+            limit $4
+        ) as page
+    ''',
+    'fetch_accounts': '''
+        select array_to_json(array_agg(row_to_json(result)))
+        from (
+            select currency_code, balance::varchar
+            from accounts
+            where user_id = $1
+        ) as result
+    ''',
+    'query_ticker_info': '''
+        select query_ticker_info($1, $2)
+    ''',
+    'fetch_candles': '''
+        select coalesce(array_to_json(array_agg(row_to_json(result))), '[]')
+        from (
+            select
+                extract(epoch from bucket) as timestamp,
+                open_price::varchar as open,
+                high_price::varchar as high,
+                low_price::varchar as low,
+                close_price::varchar as close,
+                volume::varchar
+            from candles
+            where
+                base_currency = $1 and quote_currency = $2 and
+                resolution = $3 and
+                bucket >= to_timestamp($4) at time zone 'UTC' and
+                bucket < to_timestamp($5) at time zone 'UTC'
+            order by bucket
+            limit $6
+        ) as result
+    ''',
+    'deposit_address': '''
+        select address
+        from deposit_addresses
+        where user_id = $1 and chain_index = (
+            select coalesce(max(chain_index), 0)
+            from deposit_addresses
+            where user_id = $1 and is_used
+        )
+    ''',
+    'current_bitcoin_chain_index': '''
+        select current_bitcoin_chain_index($1)
+    ''',
+    'make_withdraw_bitcoin_request': '''
+        select make_withdraw_bitcoin_request($1, $2, $3, $4)
+    ''',
+    'open_orders': '''
+        select
+            order_id, user_id, base_currency, quote_currency, price,
+            amount - filled_amount, order_type, created_at
+        from orders
+        where status = 'Open' and ($1::int[] is null or order_id = any($1))
+        order by created_at, order_id
+    ''',
+    'record_trade': '''
+        select record_trade($1, $2, $3, $4)
+    ''',
+    'match_orders': '''
+        select match_orders($1)
+    ''',
+    'process_deposits': '''
+        select process_deposits($1)
+    '''
+}
+
+# The init hook of the pool, fills the statement cache of a new
+# connection. db.prepare() bypasses that cache and running the
+# statements would change data, so this takes the path fetch() and
+# execute() use to look a statement up, which prepares it on a miss.
+# A statement that no longer matches the schema fails at startup.
+async def prepare_statements(db):
+    for query in queries.values():
+        await db._get_statement(query, None)
@@ -0,0 +1,84 @@
+import asyncio
+import asyncpg
+import contextlib
+import logging
+
+from borse.metrics import registry
+
+log = logging.getLogger(__name__)
+
+class ReadReplica:
+
+    # Read only requests go to the replica's pool while it is reachable
+    # and at most max_lag seconds behind the primary, otherwise to the
+    # primary. The lag is checked every interval seconds.
+
+    def __init__(self, pool, read_pool, max_lag, interval):
+        self.pool = pool
+        self.read_pool = read_pool
+        self.max_lag = max_lag
+        self.interval = interval
+        self.is_usable = False
+        self.lag = None
+
+        registry.gauge('borse_replica_usable',
+                       'Whether read only requests use the replica',
+                       lambda: int(self.is_usable))
+        self.fallbacks = registry.counter(
+            'borse_replica_fallbacks_total',
+            'Read only requests sent to the primary after the replica '
+            'failed')
+
+    async def measure_lag(self):
+        async with self.pool.acquire() as db:
+            primary_lsn = await db.fetchval(
+                'select pg_current_wal_lsn()::text')
+
+        # An idle primary makes pg_last_xact_replay_timestamp() look
+        # old, so a replica that has replayed everything is not behind.
+        # A server that is not a standby at all counts as current.
+        async with self.read_pool.acquire() as db:
+            return await db.fetchval('''
+                select case
+                    when not pg_is_in_recovery() then 0
+                    when pg_last_wal_replay_lsn() >= $1::pg_lsn then 0
+                    else extract(epoch from
+                        now() - pg_last_xact_replay_timestamp())::float8
+                end
+            ''', primary_lsn)
+
+    async def monitor(self):
+        while True:
+            try:
+                self.lag = await asyncio.wait_for(self.measure_lag(),
+                                                  self.interval)
+            except (asyncpg.PostgresError, OSError, asyncio.TimeoutError):
+                self.lag = None
+
+            is_usable = self.lag is not None and self.lag <= self.max_lag
+            if is_usable != self.is_usable:
+                log.warning('replica %s, lag %s',
+                            'in use' if is_usable else 'not in use',
+                            self.lag)
+            self.is_usable = is_usable
+            await asyncio.sleep(self.interval)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, is_read_only):
+        pool = self.pool
+        if is_read_only and self.is_usable:
+            try:
+                db = await self.read_pool.acquire(timeout=self.interval)
+                pool = self.read_pool
+            except (asyncpg.PostgresError, OSError, asyncio.TimeoutError):
+                # until the monitor sees it back
+                self.is_usable = False
+                self.fallbacks.inc()
+                db = await self.pool.acquire()
+        else:
+            db = await self.pool.acquire()
+
+        try:
+            yield db
+        finally:
+            await pool.release(db)
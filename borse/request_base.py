@@ -1,4 +1,5 @@
 import decimal
+import re
 import borse.bitcoin_api
 import borse.utility
 
@@ -36,12 +37,43 @@ def is_valid_bitcoin_address(bitcoin_address):
 def is_valid_amount(amount):
     return is_valid_numeric_type(amount, 8)
 
+channel_regex = re.compile(r'(trades|book|orders):[A-Z]{3}/[A-Z]{3}|ticker')
+def is_valid_channel(channel):
+    return (isinstance(channel, str) and
+            channel_regex.fullmatch(channel) is not None)
+
+def is_valid_count(count, minimum):
+    return (isinstance(count, int) and not isinstance(count, bool) and
+            count >= minimum)
+
 class RequestBase:
 
+    # no other requests of the connection run while this one does, and
+    # the next message is only read once it has finished
+    is_barrier = False
+    # only reads from the database
+    is_read_only = False
+    # process() gets a pooled connection, otherwise None
+    needs_db = True
+    # process() acquires pooled connections itself, which a batch holding
+    # one already must not do
+    acquires_db = False
+    # which rate limit applies, see command_class_rate_limits in config
+    command_class = 'other'
+
     def __init__(self, command, ident):
         self.command = command
         self.id = ident
 
+    # the requests counted against rate limits
+    def parts(self):
+        return [self]
+
+    # requests returning the same key are processed one at a time in
+    # the order they arrived, None means no ordering constraint
+    def ordering_key(self, connection):
+        return None
+
     def _check_spec(self, params, spec):
         if len(params) != len(spec):
             return False
@@ -50,6 +82,9 @@ class RequestBase:
             if isinstance(type_spec, type):
                 if not isinstance(param, type_spec):
                     return False
+                # JSON true and false are not numbers
+                if type_spec is int and isinstance(param, bool):
+                    return False
             elif type_spec == 'email':
                 if not is_valid_email(param):
                     return False
@@ -71,6 +106,15 @@ class RequestBase:
             elif type_spec == 'amount':
                 if not is_valid_amount(param):
                     return False
+            elif type_spec == 'channel':
+                if not is_valid_channel(param):
+                    return False
+            elif type_spec in ('depth', 'limit'):
+                if not is_valid_count(param, 1):
+                    return False
+            elif type_spec == 'trade_id':
+                if not is_valid_count(param, 0):
+                    return False
 
         return True
 
@@ -1,9 +1,16 @@
 import decimal
+import logging
 from borse.api import *
 from borse.request_base import *
 
+log = logging.getLogger(__name__)
+
 class RegisterRequest(RequestBase):
 
+    command_class = 'auth'
+    needs_db = False
+    acquires_db = True
+
     def unpack(self, params):
         if not self._check_spec(params, [str, 'email', str]):
             return False
@@ -12,11 +19,16 @@ class RegisterRequest(RequestBase):
         return True
 
     async def process(self, connection, db):
-        return await create_account(db, self.id, 
+        return await create_account(connection, self.id,
                                     self.username, self.email, self.password)
 
 class LoginRequest(RequestBase):
 
+    command_class = 'auth'
+    is_barrier = True
+    needs_db = False
+    acquires_db = True
+
     def unpack(self, params):
         if not self._check_spec(params, [str, str, 'public_key']):
             return False
@@ -26,33 +38,91 @@ class LoginRequest(RequestBase):
         return True
 
     async def process(self, connection, db):
-        return await login(connection, db, self.id,
+        return await login(connection, self.id,
                            self.username, self.password, self.session_key)
 
+class SessionNonce(RequestBase):
+
+    command_class = 'auth'
+    needs_db = False
+
+    def unpack(self, params):
+        return not params
+
+    async def process(self, connection, db):
+        return await session_nonce(connection, self.id)
+
+class ResumeSession(RequestBase):
+
+    command_class = 'auth'
+    is_barrier = True
+
+    def unpack(self, params):
+        if not self._check_spec(params, ['public_key', str]):
+            return False
+
+        session_key, self.signature = params
+        self.session_key = bytes.fromhex(session_key)
+        return True
+
+    async def process(self, connection, db):
+        return await resume_session(connection, db, self.id,
+                                    self.session_key, self.signature)
+
 class FetchOrderbook(RequestBase):
 
+    command_class = 'market_data'
+    is_read_only = True
+    needs_db = False
+
     def unpack(self, params):
-        if not self._check_spec(params, ['currency_code', 'currency_code']):
+        # optional depth limits the number of price levels per side
+        if self._check_spec(params, ['currency_code', 'currency_code']):
+            self.base, self.quote = params
+            self.depth = None
+            return True
+        if not self._check_spec(params, [
+            'currency_code', 'currency_code', 'depth']):
             return False
-        self.base, self.quote = params
+        self.base, self.quote, self.depth = params
         return True
 
     async def process(self, connection, db):
-        return await fetch_orderbook(db, self.id, self.base, self.quote)
+        return await fetch_orderbook(connection, self.id,
+                                     self.base, self.quote, self.depth)
 
 class FetchTrades(RequestBase):
 
+    command_class = 'market_data'
+    is_read_only = True
+
     def unpack(self, params):
-        if not self._check_spec(params, ['currency_code', 'currency_code']):
+        # either the last 24 hours, or a page of trades after a trade_id
+        if self._check_spec(params, ['currency_code', 'currency_code']):
+            self.base, self.quote = params
+            self.since_trade_id = None
+            # streamed, reads each frame on its own connection
+            self.needs_db = False
+            self.acquires_db = True
+            return True
+        if not self._check_spec(params, [
+            'currency_code', 'currency_code', 'trade_id', 'limit']):
             return False
-        self.base, self.quote = params
+        self.base, self.quote, self.since_trade_id, self.limit = params
         return True
 
     async def process(self, connection, db):
-        return await fetch_trades(db, self.id, self.base, self.quote)
+        if self.since_trade_id is None:
+            return await fetch_trades(connection, self.id,
+                                      self.base, self.quote)
+        return await fetch_trades_page(db, self.id, self.base, self.quote,
+                                       self.since_trade_id, self.limit)
 
 class TickerInfo(RequestBase):
 
+    command_class = 'market_data'
+    is_read_only = True
+
     def unpack(self, params):
         if not self._check_spec(params, ['currency_code', 'currency_code']):
             return False
@@ -62,12 +132,60 @@ class TickerInfo(RequestBase):
     async def process(self, connection, db):
         return await query_ticker_info(db, self.id, self.base, self.quote)
 
+class FetchCandles(RequestBase):
+
+    command_class = 'market_data'
+    is_read_only = True
+
+    def unpack(self, params):
+        # start and end are unix timestamps
+        if not self._check_spec(params, [
+            'currency_code', 'currency_code', str, int, int]):
+            return False
+        self.base, self.quote, self.interval, self.start, self.end = params
+        return self.interval in candle_resolutions
+
+    async def process(self, connection, db):
+        return await fetch_candles(db, self.id, self.base, self.quote,
+                                   self.interval, self.start, self.end)
+
+class Subscribe(RequestBase):
+
+    command_class = 'market_data'
+    needs_db = False
+
+    def unpack(self, params):
+        if not self._check_spec(params, ['channel']):
+            return False
+        self.channel = params[0]
+        return True
+
+    async def process(self, connection, db):
+        return await subscribe(connection, self.id, self.channel)
+
+class Unsubscribe(RequestBase):
+
+    command_class = 'market_data'
+    needs_db = False
+
+    def unpack(self, params):
+        if not self._check_spec(params, ['channel']):
+            return False
+        self.channel = params[0]
+        return True
+
+    async def process(self, connection, db):
+        return await unsubscribe(connection, self.id, self.channel)
+
 #########################################
 #       AUTHENTICATED REQUESTS          #
 #########################################
 
 class HelloRequest(RequestBase):
 
+    command_class = 'account'
+    needs_db = False
+
     def unpack(self, params):
         if not self._check_spec(params, [str]):
             return False
@@ -75,11 +193,24 @@ class HelloRequest(RequestBase):
         return True
 
     async def process(self, connection, db):
-        print('hello')
+        log.info('hello from user %s', connection.user_id)
         return make_response(self.id, None)
 
+class LogoutRequest(RequestBase):
+
+    command_class = 'auth'
+    is_barrier = True
+
+    def unpack(self, params):
+        return not params
+
+    async def process(self, connection, db):
+        return await logout(connection, db, self.id)
+
 class PlaceOrderRequest(RequestBase):
 
+    command_class = 'trading'
+
     def unpack(self, params):
         if not self._check_spec(params, [
             'currency_code', 'currency_code', 'order_value', 'order_value',
@@ -90,6 +221,9 @@ class PlaceOrderRequest(RequestBase):
         self.amount = decimal.Decimal(self.amount)
         return True
 
+    def ordering_key(self, connection):
+        return ('user', connection.user_id)
+
     async def process(self, connection, db):
         assert connection.user_id is not None
         return await place_order(connection, db, self.id, connection.user_id,
@@ -97,6 +231,9 @@ class PlaceOrderRequest(RequestBase):
 
 class FetchAccounts(RequestBase):
 
+    command_class = 'account'
+    is_read_only = True
+
     def unpack(self, params):
         return not params
 
@@ -106,6 +243,8 @@ class FetchAccounts(RequestBase):
 
 class GetBitcoinDepositAddress(RequestBase):
 
+    command_class = 'account'
+
     def unpack(self, params):
         return not params
 
@@ -114,31 +253,85 @@ class GetBitcoinDepositAddress(RequestBase):
         return await get_bitcoin_deposit_address(
             db, self.id, connection.user_id)
 
+class ServerStats(RequestBase):
+
+    command_class = 'account'
+    is_read_only = True
+    needs_db = False
+
+    def unpack(self, params):
+        return not params
+
+    async def process(self, connection, db):
+        return await server_stats(self.id, connection.user_id)
+
 class WithdrawBitcoin(RequestBase):
 
+    command_class = 'trading'
+
     def unpack(self, params):
         if not self._check_spec(params, ['bitcoin_address', 'amount']):
             return False
         self.address, self.amount = params
         return True
 
+    def ordering_key(self, connection):
+        return ('user', connection.user_id)
+
     async def process(self, connection, db):
         return await make_withdraw_bitcoin_request(
             db, self.id, connection.user_id, self.address, self.amount)
 
+class BatchRequest(RequestBase):
+
+    def __init__(self, requests):
+        super().__init__('batch', None)
+        self.requests = requests
+        self.is_read_only = all(request.is_read_only for request in requests)
+        self.needs_db = any(request.needs_db for request in requests)
+
+    def parts(self):
+        return self.requests
+
+    def ordering_key(self, connection):
+        keys = [request.ordering_key(connection) for request in self.requests]
+        # all keys of one connection are its user's
+        keys = [key for key in keys if key is not None]
+        return keys[0] if keys else None
+
+    async def process(self, connection, db):
+        # Writes make their own commits, place_order hands the order to
+        # the matcher right after it. A read only batch shares a snapshot,
+        # one served from memory has no connection.
+        if not self.is_read_only or db is None:
+            return await self.process_requests(connection, db)
+
+        async with db.transaction(readonly=True):
+            return await self.process_requests(connection, db)
+
+    async def process_requests(self, connection, db):
+        return [await request.process(connection, db)
+                for request in self.requests]
+
 request_types = {
     'register': RegisterRequest,
     'login': LoginRequest,
+    'session_nonce': SessionNonce,
+    'resume_session': ResumeSession,
     'fetch_orderbook': FetchOrderbook,
     'fetch_trades': FetchTrades,
-    'ticker_info': TickerInfo
+    'ticker_info': TickerInfo,
+    'fetch_candles': FetchCandles,
+    'subscribe': Subscribe,
+    'unsubscribe': Unsubscribe
 }
 
 authenticated_request_types = {
     'say_hello': HelloRequest,
+    'logout': LogoutRequest,
     'place_order': PlaceOrderRequest,
     'fetch_accounts': FetchAccounts,
     'get_bitcoin_deposit_address': GetBitcoinDepositAddress,
-    'withdraw_bitcoin': WithdrawBitcoin
+    'withdraw_bitcoin': WithdrawBitcoin,
+    'server_stats': ServerStats
 }
-
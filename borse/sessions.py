@@ -0,0 +1,45 @@
+import collections
+import time
+
+class SessionCache:
+
+    # Active sessions that logged in or resumed recently, so resuming one
+    # usually needs no database read. Their last_updated_at is written
+    # back at most every touch_interval seconds.
+    touch_interval = 60
+
+    def __init__(self, lifetime, limit):
+        self.lifetime = lifetime
+        self.limit = limit
+        # session_key -> [user_id, time.monotonic() of the last touch]
+        self.sessions = collections.OrderedDict()
+
+    # age is the seconds since last_updated_at in the database
+    def add(self, session_key, user_id, age=0):
+        self.sessions[session_key] = [user_id, time.monotonic() - age]
+        self.sessions.move_to_end(session_key)
+        if len(self.sessions) > self.limit:
+            self.sessions.popitem(last=False)
+
+    def get(self, session_key):
+        entry = self.sessions.get(session_key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[1] >= self.lifetime:
+            del self.sessions[session_key]
+            return None
+        self.sessions.move_to_end(session_key)
+        return entry[0]
+
+    def needs_touch(self, session_key):
+        entry = self.sessions.get(session_key)
+        return (entry is not None and
+                time.monotonic() - entry[1] >= self.touch_interval)
+
+    def touch(self, session_key):
+        entry = self.sessions.get(session_key)
+        if entry is not None:
+            entry[1] = time.monotonic()
+
+    def revoke(self, session_key):
+        self.sessions.pop(session_key, None)
@@ -1,10 +1,6 @@
 import decimal
 import re
 import string
-import sys
-
-def eprint(*args, **kwargs):
-    print('error:', *args, file=sys.stderr, **kwargs)
 
 def is_hex(hex_string, length):
     return (len(hex_string) == length * 2 and
@@ -1,19 +1,70 @@
+import asyncio
+import concurrent.futures
 import ed25519
 
 class PublicKey:
 
     def __init__(self, public_key):
+        self.public_key = public_key
         self._key = ed25519.VerifyingKey(public_key)
 
     def verify(self, message, signature):
-        assert isinstance(message, str)
+        # MessagePack requests are signed as bytes
+        if isinstance(message, str):
+            message = message.encode()
+        assert isinstance(message, bytes)
         assert isinstance(signature, str)
 
         try:
-            self._key.verify(signature, message.encode(),
-                             encoding='base64')
-        except (ed25519.BadSignatureError, AssertionError):
+            self._key.verify(signature, message, encoding='base64')
+        except (ed25519.BadSignatureError, AssertionError, ValueError):
             return False
 
         return True
 
+# runs in the worker processes
+def _verify_batch(items):
+    return [PublicKey(public_key).verify(message, signature)
+            for public_key, message, signature in items]
+
+class SignatureVerifier:
+
+    # Verifications requested during one iteration of the event loop,
+    # from any connection, are sent to the workers together to pay the
+    # inter-process overhead once per batch rather than per message.
+
+    def __init__(self, workers, batch_size):
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+        self.batch_size = batch_size
+        self.pending = []
+
+    def verify(self, public_key, message, signature):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if not self.pending:
+            loop.call_soon(self._flush)
+        self.pending.append(
+            (public_key.public_key, message, signature, future))
+        return future
+
+    def _flush(self):
+        pending, self.pending = self.pending, []
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            asyncio.ensure_future(self._verify_batch(batch))
+
+    async def _verify_batch(self, batch):
+        futures = [item[3] for item in batch]
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(
+                self.executor, _verify_batch,
+                [item[:3] for item in batch])
+        except Exception as error:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
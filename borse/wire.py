@@ -0,0 +1,65 @@
+from websockets.extensions.permessage_deflate import (
+    ServerPerMessageDeflateFactory)
+try:
+    from websockets.frames import OP_BINARY, OP_TEXT
+except ImportError:
+    from websockets.framing import OP_BINARY, OP_TEXT
+
+import borse.config
+import borse.encoding
+
+# Clients pick the encoding of replies and events when connecting. The
+# messages are the same, decimals are still strings. Without a
+# subprotocol, JSON is used.
+JSON_PROTOCOL = 'borse.json'
+MSGPACK_PROTOCOL = 'borse.msgpack'
+
+def subprotocols():
+    if borse.encoding.msgpack is None:
+        return [JSON_PROTOCOL]
+    return [MSGPACK_PROTOCOL, JSON_PROTOCOL]
+
+class ThresholdDeflate:
+
+    # Wraps permessage-deflate to send messages under min_size as they
+    # are. That is allowed per message, and leaves the compression
+    # context alone.
+    def __init__(self, extension, min_size):
+        self.extension = extension
+        self.min_size = min_size
+
+    @property
+    def name(self):
+        return self.extension.name
+
+    def decode(self, frame, **kwargs):
+        return self.extension.decode(frame, **kwargs)
+
+    def encode(self, frame):
+        # replies are never fragmented, so this is a whole message
+        if (frame.opcode in (OP_TEXT, OP_BINARY) and frame.fin and
+                len(frame.data) < self.min_size):
+            return frame
+        return self.extension.encode(frame)
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, min_size, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(
+            params, accepted_extensions)
+        return response_params, ThresholdDeflate(extension, self.min_size)
+
+def extensions():
+    if borse.config.compression != 'deflate':
+        return []
+    return [ThresholdDeflateFactory(
+        borse.config.compression_min_size,
+        server_max_window_bits=borse.config.compression_window_bits or None,
+        compress_settings={
+            'level': borse.config.compression_level,
+            'memLevel': borse.config.compression_memory_level
+        })]
@@ -3,12 +3,14 @@ import asyncio
 import ed25519
 import json
 import random
+import time
 import websockets
-from decimal import Decimal as D
 from tabulate import tabulate
 from termcolor import colored
 
 id_command_map = {}
+# results of streamed replies received so far
+partial_results = {}
 
 async def send(websocket, session, command, params):
     ident = random.randint(0, 2**32)
@@ -55,6 +57,14 @@ async def show_replies(websocket):
             print('Error (#%s):' % reply['id'], reply['error'])
             continue
 
+        if reply.get('more'):
+            partial_results.setdefault(reply['id'], []).extend(
+                reply['result'])
+            continue
+        if reply['id'] in partial_results:
+            reply['result'] = (partial_results.pop(reply['id']) +
+                               reply['result'])
+
         command = id_command_map[reply['id']]
         process_reply(command, reply)
 
@@ -65,34 +75,16 @@ def process_reply(command, reply):
     elif command == 'register':
         print(f"< {reply}")
     elif command == 'fetch_orderbook':
-        buy = []
-        sell = []
-
-        for order in result:
-            price, amount, order_type, timestamp = (
-                order['price'], order['amount'], order['order_type'],
-                order['timestamp'])
-            price = D(price)
-            amount = D(amount)
-            timestamp = str(timestamp)
-            assert order_type == 'Buy' or order_type == 'Sell'
-            if order_type == 'Buy':
-                buy.append((price, amount, timestamp))
-            elif order_type == 'Sell':
-                sell.append((price, amount, timestamp))
-
-        buy.sort(key=lambda row: row[0], reverse=True)
-        sell.sort(key=lambda row: row[0], reverse=True)
-
         rows = []
 
-        for price, amount, timestamp in sell:
-            rows.append((colored(price, 'red'), amount, timestamp))
-        for price, amount, timestamp in buy:
-            rows.append((colored(price, 'green'), amount, timestamp))
+        for price, amount in reversed(result['asks']):
+            rows.append((colored(price, 'red'), amount))
+        for price, amount in result['bids']:
+            rows.append((colored(price, 'green'), amount))
 
+        print('Sequence:', result['sequence'])
         print(tabulate(rows, (
-            "Price", "Amount", "Time")))
+            "Price", "Amount")))
     elif command == 'fetch_trades':
         rows = [(row['price'], row['amount'], row['timestamp'])
                 for row in result]
@@ -101,6 +93,9 @@ def process_reply(command, reply):
     elif command == 'say_hello':
         print(f"< {reply}")
     elif command == 'ticker_info':
+        if result is None:
+            print('No trades yet')
+            return
         print('Low: ', result['low_price'])
         print('High: ', result['high_price'])
         print('Open: ', result['open_price'])
@@ -113,6 +108,24 @@ def process_reply(command, reply):
             print(balance, code)
     elif command == 'get_bitcoin_deposit_address':
         print('Address:', result)
+    elif command == 'fetch_candles':
+        rows = [(row['timestamp'], row['open'], row['high'], row['low'],
+                 row['close'], row['volume'])
+                for row in result]
+        print(tabulate(rows, (
+            "Time", "Open", "High", "Low", "Close", "Volume")))
+    elif command == 'subscribe':
+        print(f"< {reply}")
+    elif command == 'unsubscribe':
+        print(f"< {reply}")
+    elif command == 'logout':
+        print(f"< {reply}")
+    elif command == 'server_stats':
+        if result is None:
+            print(f"< {reply}")
+            return
+        for name, value in result.items():
+            print(name, value)
 
 async def poll(websocket, session):
     print()
@@ -128,6 +141,15 @@ async def poll(websocket, session):
     print('  [8] Show accounts')
     print('  [9] Bitcoin deposit address')
     print('  [10] Withdraw Bitcoin')
+    print('Subscriptions:')
+    print('  [11] Subscribe')
+    print('  [12] Unsubscribe')
+    print('Charts:')
+    print('  [13] Candles')
+    print('Admin:')
+    print('  [14] Server stats')
+    print('Session:')
+    print('  [15] Logout')
 
     choice = int(await aioconsole.ainput('> '))
 
@@ -151,6 +173,16 @@ async def poll(websocket, session):
         await bitcoin_address(websocket, session)
     elif choice == 10:
         await withdraw_bitcoin(websocket, session)
+    elif choice == 11:
+        await subscribe(websocket, session)
+    elif choice == 12:
+        await unsubscribe(websocket, session)
+    elif choice == 13:
+        await candles(websocket, session)
+    elif choice == 14:
+        await server_stats(websocket, session)
+    elif choice == 15:
+        await logout(websocket, session)
 
 async def login(websocket, session):
     assert not session
@@ -225,4 +257,36 @@ async def withdraw_bitcoin(websocket, session):
 
     await send(websocket, session, 'withdraw_bitcoin', [address, amount])
 
-asyncio.get_event_loop().run_until_complete(main())
+async def subscribe(websocket, session):
+    print('Channel: trades:BASE/QUOTE, book:BASE/QUOTE, orders:BASE/QUOTE'
+          ' or ticker')
+    channel = await aioconsole.ainput('Channel: ')
+
+    await send(websocket, session, 'subscribe', [channel])
+
+async def unsubscribe(websocket, session):
+    channel = await aioconsole.ainput('Channel: ')
+
+    await send(websocket, session, 'unsubscribe', [channel])
+
+async def candles(websocket, session):
+    base = (await aioconsole.ainput('Base: ')).upper()
+    quote = (await aioconsole.ainput('Quote: ')).upper()
+    interval = await aioconsole.ainput('Interval (1m, 1h, 1d): ')
+    hours = int(await aioconsole.ainput('Last hours: '))
+
+    end = int(time.time())
+    start = end - hours * 3600
+
+    await send(websocket, session, 'fetch_candles', [
+        base, quote, interval, start, end])
+
+async def logout(websocket, session):
+    await send(websocket, session, 'logout', [])
+    session.clear()
+
+async def server_stats(websocket, session):
+    await send(websocket, session, 'server_stats', [])
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
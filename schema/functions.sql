@@ -34,7 +34,9 @@ $$ language sql;
 drop type if exists place_order_result cascade;
 create type place_order_result as (
     deduct_currency currency_type,
-    deduct_amount amount_type
+    deduct_amount amount_type,
+    order_id int,
+    created_at timestamp
 );
 
 drop function if exists place_order;
@@ -46,6 +48,8 @@ returns place_order_result as $$
 declare
     deduct_currency currency_type = 'BTC';
     deduct_amount amount_type = '0';
+    _order_id int;
+    _created_at timestamp;
 begin
     if _order_type = 'Buy' then
         deduct_currency = _quote_currency;
@@ -66,9 +70,9 @@ begin
         user_id, quote_currency, base_currency, price, amount, order_type
     ) values (
         _user_id, _quote_currency, _base_currency, _price, _amount, _order_type
-    );
+    ) returning order_id, created_at into _order_id, _created_at;
 
-    return (deduct_currency, deduct_amount);
+    return (deduct_currency, deduct_amount, _order_id, _created_at);
 end
 $$ language plpgsql;
 
@@ -109,3 +113,99 @@ create function current_bitcoin_chain_index(user_id int) returns int as $$
     on bitcoin_deposits.account_event_id = event.account_event_id;
 $$ language sql;
 
+
+-- Records a deposit on one of the addresses in deposit_addresses and
+-- returns its account_event_id, or null for an unknown address.
+drop function if exists make_bitcoin_deposit;
+create function make_bitcoin_deposit(
+    address varchar, transaction_id varchar, amount amount_type)
+returns int as $$
+    with address as (
+        update deposit_addresses
+        set is_used = true
+        where address = $1
+        returning user_id, chain_index
+    ), insert_1 as (
+        insert into account_events (account_id, event, amount, fee)
+        select account_id, 'Deposit', $3, 0
+        from accounts
+        join address on accounts.user_id = address.user_id
+        where currency_code = 'BTC'
+        returning account_event_id
+    )
+    insert into bitcoin_deposits (account_event_id, transaction_id, chain_index)
+    select account_event_id, $2, chain_index from insert_1, address
+    returning account_event_id;
+$$ language sql;
+
+-- wake up the matcher in every server process, also for orders and
+-- deposits inserted by other writers
+drop function if exists notify_order_placed cascade;
+create function notify_order_placed() returns trigger as $$
+begin
+    perform pg_notify('borse_orders', new.order_id::text);
+    return null;
+end
+$$ language plpgsql;
+
+create trigger order_placed
+after insert on orders
+for each row execute procedure notify_order_placed();
+
+drop function if exists notify_deposit cascade;
+create function notify_deposit() returns trigger as $$
+begin
+    perform pg_notify('borse_deposits', '');
+    return null;
+end
+$$ language plpgsql;
+
+create trigger deposit_made
+after insert on account_events
+for each statement execute procedure notify_deposit();
+
+-- evict the session from the cache of every server process, however
+-- it was deactivated
+drop function if exists notify_session_revoked cascade;
+create function notify_session_revoked() returns trigger as $$
+begin
+    perform pg_notify('borse_sessions', encode(new.session_key, 'hex'));
+    return null;
+end
+$$ language plpgsql;
+
+create trigger session_revoked
+after update of is_active on sessions
+for each row when (old.is_active and not new.is_active)
+execute procedure notify_session_revoked();
+
+-- Credits up to max_events open deposits and returns how many it
+-- closed. Rows locked by another worker are skipped, so several can
+-- drain the queue at once without crediting an event twice.
+drop function if exists process_deposits;
+create function process_deposits(max_events int) returns int as $$
+    with events as (
+        select account_event_id, account_id, amount
+        from account_events
+        where event = 'Deposit' and status = 'Open'
+        order by account_event_id
+        limit $1
+        for update skip locked
+    ), closed as (
+        update account_events
+        set status = 'Closed'
+        from events
+        where account_events.account_event_id = events.account_event_id
+        returning events.account_id, events.amount
+    ), credited as (
+        update accounts
+        set balance = balance + totals.amount
+        from (
+            select account_id, sum(amount) as amount
+            from closed
+            group by account_id
+        ) as totals
+        where accounts.account_id = totals.account_id
+    )
+    select count(*)::int from closed;
+$$ language sql;
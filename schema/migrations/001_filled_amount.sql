@@ -0,0 +1,25 @@
+-- orders.filled_amount and orders.filled_volume replace summing trades
+-- in remaining_amount() and update_balance_if_closed_order()
+-- reload trade_engine.sql after running this
+
+alter table orders
+    add column if not exists filled_amount order_value_type default 0,
+    add column if not exists filled_volume amount_type default 0;
+
+with filled as (
+    select
+        order_id,
+        sum(trade_amount) as filled_amount,
+        sum(trade_amount * trade_price) as filled_volume
+    from orders
+    join trades
+    on (order_type = 'Buy' and buy_id = order_id) or
+       (order_type = 'Sell' and sell_id = order_id)
+    group by order_id
+)
+update orders
+set
+    filled_amount = filled.filled_amount,
+    filled_volume = filled.filled_volume
+from filled
+where orders.order_id = filled.order_id;
@@ -0,0 +1,19 @@
+-- indexes for the matching, market data and deposit queries
+-- concurrently so this can run against a live database, which also
+-- means it must not be wrapped in a transaction
+
+create index concurrently if not exists orders_open_by_type
+on orders (order_type, price) where status = 'Open';
+
+create index concurrently if not exists orders_open_by_pair
+on orders (base_currency, quote_currency, order_type, price)
+where status = 'Open';
+
+create index concurrently if not exists trades_buy_id on trades (buy_id);
+create index concurrently if not exists trades_sell_id on trades (sell_id);
+create index concurrently if not exists trades_created_at
+on trades (created_at);
+
+create index concurrently if not exists account_events_open_deposits
+on account_events (account_event_id)
+where event = 'Deposit' and status = 'Open';
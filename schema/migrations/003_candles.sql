@@ -0,0 +1,42 @@
+-- candles replace aggregating trades in query_ticker_info()
+-- reload trade_engine.sql and ticker.sql after running this
+
+create table if not exists candles (
+    base_currency       currency_type references currencies(currency_code),
+    quote_currency      currency_type references currencies(currency_code),
+    resolution          varchar not null,
+    bucket              timestamp not null,
+    open_price          order_value_type,
+    high_price          order_value_type,
+    low_price           order_value_type,
+    close_price         order_value_type,
+    volume              amount_type,
+    quote_volume        amount_type,
+    primary key (base_currency, quote_currency, resolution, bucket)
+);
+
+with pair_trades as (
+    select
+        base_currency, quote_currency, resolution,
+        date_trunc(resolution, trades.created_at) as bucket,
+        trade_id, trade_price, trade_amount
+    from trades
+    join orders on buy_id = order_id
+    cross join unnest(array['minute', 'hour', 'day']) as resolution
+)
+insert into candles (
+    base_currency, quote_currency, resolution, bucket,
+    open_price, high_price, low_price, close_price,
+    volume, quote_volume
+)
+select
+    base_currency, quote_currency, resolution, bucket,
+    (array_agg(trade_price order by trade_id))[1],
+    max(trade_price),
+    min(trade_price),
+    (array_agg(trade_price order by trade_id desc))[1],
+    sum(trade_amount),
+    sum(trade_amount * trade_price)
+from pair_trades
+group by base_currency, quote_currency, resolution, bucket
+on conflict do nothing;
@@ -0,0 +1,12 @@
+-- addresses derived ahead of time by the server, which fills the table
+-- in the background and takes the used chain indexes of existing users
+-- from current_bitcoin_chain_index()
+-- reload functions.sql after running this
+
+create table if not exists deposit_addresses (
+    address             varchar primary key,
+    user_id             int not null references users(user_id),
+    chain_index         int not null,
+    is_used             bool not null default false,
+    unique(user_id, chain_index)
+);
@@ -89,6 +89,16 @@ create table bitcoin_deposits (
     chain_index         int not null
 );
 
+-- addresses derived ahead of time by the server, is_used is set once a
+-- deposit arrives on the address
+create table deposit_addresses (
+    address             varchar primary key,
+    user_id             int not null references users(user_id),
+    chain_index         int not null,
+    is_used             bool not null default false,
+    unique(user_id, chain_index)
+);
+
 create table orders (
     order_id            serial primary key,
     user_id             int not null references users(user_id),
@@ -98,6 +108,10 @@ create table orders (
     price               order_value_type,
     -- and amount too, therefore result will have 8 decimals
     amount              order_value_type,
+    -- sums of trade_amount and trade_amount * trade_price over the
+    -- trades of this order, kept up to date by record_trade()
+    filled_amount       order_value_type default 0,
+    filled_volume       amount_type default 0,
     status              status_type not null default 'Open',
     order_type          order_enum_type not null,
     created_at          timestamp not null default now()
@@ -134,6 +148,42 @@ create table trades (
     created_at          timestamp not null default now()
 );
 
+-- open, high, low, close and volume of the trades of a pair per
+-- bucket, resolution is 'minute', 'hour' or 'day'
+create table candles (
+    base_currency       currency_type references currencies(currency_code),
+    quote_currency      currency_type references currencies(currency_code),
+    resolution          varchar not null,
+    bucket              timestamp not null,
+    open_price          order_value_type,
+    high_price          order_value_type,
+    low_price           order_value_type,
+    close_price         order_value_type,
+    volume              amount_type,
+    quote_volume        amount_type,
+    primary key (base_currency, quote_currency, resolution, bucket)
+);
+
+-- keep in sync with migrations/002_indexes.sql
+
+-- best buy over all pairs in match_one_order()
+create index orders_open_by_type
+on orders (order_type, price) where status = 'Open';
+
+-- matching sell in match_one_order() and fetch_orderbook
+create index orders_open_by_pair
+on orders (base_currency, quote_currency, order_type, price)
+where status = 'Open';
+
+create index trades_buy_id on trades (buy_id);
+create index trades_sell_id on trades (sell_id);
+create index trades_created_at on trades (created_at);
+
+-- process_deposits
+create index account_events_open_deposits
+on account_events (account_event_id)
+where event = 'Deposit' and status = 'Open';
+
 \i functions.sql
 
 insert into currencies (currency_code, name, is_crypto) values
@@ -1,42 +1,46 @@
--- this should be cached in a special table
--- fetch day of last trade, generate ticker info up to day before
+-- candles are kept up to date by record_trade() for every resolution
+-- below, named after the date_trunc() field of their buckets
+
+drop function if exists update_candles;
+create function update_candles(
+    _base_currency currency_type, _quote_currency currency_type,
+    _trade_price order_value_type, _trade_amount order_value_type,
+    _created_at timestamp)
+returns void as $$
+    insert into candles (
+        base_currency, quote_currency, resolution, bucket,
+        open_price, high_price, low_price, close_price,
+        volume, quote_volume
+    )
+    select
+        $1, $2, resolution, date_trunc(resolution, $5),
+        $3, $3, $3, $3,
+        $4, $4 * $3
+    from unnest(array['minute', 'hour', 'day']) as resolution
+    on conflict (base_currency, quote_currency, resolution, bucket)
+    do update set
+        high_price = greatest(candles.high_price, excluded.high_price),
+        low_price = least(candles.low_price, excluded.low_price),
+        close_price = excluded.close_price,
+        volume = candles.volume + excluded.volume,
+        quote_volume = candles.quote_volume + excluded.quote_volume;
+$$ language sql;
 
 drop function if exists query_ticker_info;
 create function query_ticker_info(base currency_type, quote currency_type)
 returns json as $$
-    with filtered_trades as (
-        select trade_price, trades.created_at as created_at from trades
-        join orders on buy_id = order_id
-        where base_currency = base and quote_currency = quote
-    ), limits as (
+    select row_to_json(result)
+    from (
         select
-            min(trade_price) as low_price,
-            max(trade_price) as high_price,
-            date_trunc('day', created_at) as limits_daily
-        from filtered_trades
-        group by limits_daily
-        order by limits_daily
-    ), open as (
-        select distinct on (open_daily)
-            low_price,
-            high_price,
-            trade_price as open_price,
-            date_trunc('day', created_at) as open_daily
-        from filtered_trades
-        join limits on limits_daily = date_trunc('day', created_at)
-        order by open_daily, created_at asc
-    ), close as (
-        select distinct on (daily)
             low_price::varchar,
             high_price::varchar,
             open_price::varchar,
-            trade_price::varchar as close_price,
-            date_trunc('day', created_at) as daily
-        from filtered_trades
-        join open on open_daily = date_trunc('day', created_at)
-        order by daily, created_at desc
-    )
-    select array_to_json(array_agg(row_to_json(close)))
-    from close;
+            close_price::varchar
+        from candles
+        where
+            base_currency = base and quote_currency = quote and
+            resolution = 'day'
+        order by bucket desc
+        limit 1
+    ) as result;
 $$ language sql;
-
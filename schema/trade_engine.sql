@@ -1,20 +1,7 @@
 drop function if exists remaining_amount;
 create function remaining_amount(order_id int) returns order_value_type as $$
-    with order_select as (
-        select amount as order_amount, order_type
-        from orders where order_id = $1
-    ),
-    trades_sum as (
-        select coalesce(sum(trade_amount), 0) as total_traded
-        from trades
-        where 
-            case (select order_type from order_select)
-                when 'Buy' then buy_id = $1
-                when 'Sell' then sell_id = $1
-            end
-    )
-    select cast(order_amount - total_traded as order_value_type)
-    from order_select, trades_sum
+    select cast(amount - filled_amount as order_value_type)
+    from orders where order_id = $1
 $$ language sql;
 
 drop function if exists update_balance_if_closed_order;
@@ -26,7 +13,14 @@ declare
     _order_type order_enum_type;
     total_traded amount_type = '0';
 begin
-    select status, order_type into order_status, _order_type
+    select
+        status,
+        order_type,
+        case order_type
+            when 'Buy' then filled_amount
+            when 'Sell' then filled_volume
+        end
+    into order_status, _order_type, total_traded
     from orders
     where order_id = _order_id;
 
@@ -34,16 +28,6 @@ begin
         return;
     end if;
 
-    if _order_type = 'Buy' then
-        select sum(trade_amount) into total_traded
-        from trades
-        where buy_id = _order_id;
-    else
-        select sum(trade_amount * trade_price) into total_traded
-        from trades
-        where sell_id = _order_id;
-    end if;
-
     raise notice 'Updating balance % % % %',
         _order_id, _user_id, _currency_code, total_traded;
 
@@ -53,6 +37,48 @@ begin
 end
 $$ language plpgsql;
 
+drop function if exists record_trade;
+create function record_trade(_buy_id int, _sell_id int,
+    _trade_price order_value_type, _trade_amount order_value_type)
+returns void as $$
+declare
+    buy_order record;
+    sell_order record;
+    _created_at timestamp;
+begin
+    insert into trades (
+        trade_price, trade_amount, buy_id, buy_fee, sell_id, sell_fee
+    ) values (
+        _trade_price, _trade_amount, _buy_id, 0, _sell_id, 0)
+    returning created_at into _created_at;
+
+    update orders
+    set
+        filled_amount = filled_amount + _trade_amount,
+        filled_volume = filled_volume + _trade_amount * _trade_price,
+        status = case
+            when filled_amount + _trade_amount = amount then 'Closed'
+            else status
+        end
+    where order_id in (_buy_id, _sell_id);
+
+    select user_id, base_currency, quote_currency into buy_order
+    from orders where order_id = _buy_id;
+
+    perform update_candles(buy_order.base_currency, buy_order.quote_currency,
+        _trade_price, _trade_amount, _created_at);
+
+    select user_id, quote_currency into sell_order
+    from orders where order_id = _sell_id;
+
+    perform update_balance_if_closed_order(
+        _buy_id, buy_order.user_id, buy_order.base_currency);
+
+    perform update_balance_if_closed_order(
+        _sell_id, sell_order.user_id, sell_order.quote_currency);
+end
+$$ language plpgsql;
+
 drop function if exists match_one_order;
 create function match_one_order() returns varchar as $$
 declare
@@ -74,11 +100,13 @@ begin
         buy_order.order_id as buy_order_id,
         buy_order.user_id as buy_user_id,
         buy_order.price as buy_price,
+        buy_order.amount - buy_order.filled_amount as buy_remaining,
         buy_order.created_at as buy_created_at,
 
         sell_orders.order_id as sell_order_id,
         sell_orders.user_id as sell_user_id,
         sell_orders.price as sell_price,
+        sell_orders.amount - sell_orders.filled_amount as sell_remaining,
         sell_orders.created_at as sell_created_at
     from buy_order, orders as sell_orders
     into match
@@ -106,26 +134,10 @@ begin
         trade_price = least(match.buy_price, match.sell_price);
     end if;
 
-    trade_amount = least(
-        remaining_amount(match.buy_order_id),
-        remaining_amount(match.sell_order_id));
+    trade_amount = least(match.buy_remaining, match.sell_remaining);
 
-    insert into trades (
-        trade_price, trade_amount, buy_id, buy_fee, sell_id, sell_fee
-    ) values (
-        trade_price, trade_amount, match.buy_order_id, 0,
-        match.sell_order_id, 0);
-
-    update orders
-    set status = 'Closed'
-    where
-        order_id = any(order_ids) and remaining_amount(order_id) = 0;
-
-    perform update_balance_if_closed_order(
-        match.buy_order_id, match.buy_user_id, match.base_currency);
-
-    perform update_balance_if_closed_order(
-        match.sell_order_id, match.sell_user_id, match.quote_currency);
+    perform record_trade(
+        match.buy_order_id, match.sell_order_id, trade_price, trade_amount);
 
     update orders
     set status = 'Open'
@@ -134,9 +146,28 @@ begin
     raise notice 'price % @ % (%)', trade_amount, trade_price, match;
 
     return json_build_object(
-        'price', trade_price, 'amount', trade_amount,
-        'base', match.base_currency, 'quote', match.quote_currency
+        'price', trade_price::varchar, 'amount', trade_amount::varchar,
+        'base', match.base_currency, 'quote', match.quote_currency,
+        'buy_id', match.buy_order_id, 'sell_id', match.sell_order_id,
+        'buy_price', match.buy_price::varchar,
+        'sell_price', match.sell_price::varchar
     );
 end
 $$ language plpgsql;
 
+
+drop function if exists match_orders;
+create function match_orders(max_trades int) returns json as $$
+declare
+    trades json[] = '{}';
+    trade varchar;
+begin
+    for i in 1..max_trades loop
+        trade = match_one_order();
+        exit when trade is null;
+        trades = trades || trade::json;
+    end loop;
+
+    return array_to_json(trades);
+end
+$$ language plpgsql;
@@ -1,33 +1,133 @@
 import asyncio
 import asyncpg
+import logging
+import multiprocessing
 import sys
+import time
 import websockets
 
+import borse.config
+import borse.wire
 from borse.application import Application
+from borse.log import setup_logging
+from borse.matching_engine import MatchingEngine
+from borse.metrics import serve_metrics
+from borse.password import PasswordHasher
+from borse.queries import prepare_statements, queries
+from borse.replica import ReadReplica
+from borse.verify_signature import SignatureVerifier
+
+log = logging.getLogger('borse.server')
+
+# create_pool opens min_size connections and prepares the statements on
+# each before returning
+def create_pool(dsn, min_size, max_size):
+    return asyncpg.create_pool(
+        dsn,
+        min_size=min_size,
+        max_size=max_size,
+        statement_cache_size=borse.config.statement_cache_size,
+        command_timeout=borse.config.command_timeout or None,
+        max_inactive_connection_lifetime=
+            borse.config.max_inactive_connection_lifetime,
+        init=prepare_statements)
 
 async def setup_database():
     try:
-        pool = await asyncpg.create_pool('postgresql://kk@localhost/borse')
+        pool = await create_pool(borse.config.database_dsn,
+                                 borse.config.pool_min_size,
+                                 borse.config.pool_max_size)
     except OSError:
-        print('Error: unable to connect to database', file=sys.stderr)
+        log.error('unable to connect to database')
         return None
 
+    log.info('%s database connections ready with %s prepared statements',
+             pool.get_size(), len(queries))
     return pool
 
-def main():
+async def setup_replica(pool):
+    try:
+        read_pool = await create_pool(borse.config.read_database_dsn,
+                                      borse.config.read_pool_min_size,
+                                      borse.config.read_pool_max_size)
+    except (asyncpg.PostgresError, OSError):
+        # connect lazily, the primary serves reads until it is up
+        log.warning('unable to connect to the replica')
+        read_pool = await create_pool(borse.config.read_database_dsn,
+                                      0, borse.config.read_pool_max_size)
+
+    return ReadReplica(pool, read_pool, borse.config.max_replication_lag,
+                       borse.config.replica_check_interval)
+
+def run_worker(index=0):
+    setup_logging()
+
     pool = asyncio.get_event_loop().run_until_complete(setup_database())
     if pool is None:
         return -1
 
-    app = Application(pool)
+    matching_engine = None
+    if borse.config.matching_engine == 'memory':
+        matching_engine = MatchingEngine()
+
+    password_hasher = PasswordHasher(borse.config.password_workers,
+                                     borse.config.password_queue_size)
+
+    signature_verifier = None
+    if borse.config.signature_workers:
+        signature_verifier = SignatureVerifier(
+            borse.config.signature_workers,
+            borse.config.signature_batch_size)
 
-    start_server = websockets.serve(app.on_connect, 'localhost', 8765)
+    replica = None
+    if borse.config.read_database_dsn:
+        replica = asyncio.get_event_loop().run_until_complete(
+            setup_replica(pool))
+
+    app = Application(pool, password_hasher, signature_verifier,
+                      matching_engine, replica)
+    asyncio.get_event_loop().run_until_complete(app.setup())
+
+    # workers share the port, the kernel spreads connections over them
+    start_server = websockets.serve(
+        app.on_connect, 'localhost', 8765,
+        reuse_port=borse.config.workers > 1,
+        subprotocols=borse.wire.subprotocols(),
+        compression=None, extensions=borse.wire.extensions())
 
     asyncio.get_event_loop().run_until_complete(start_server)
+
+    # every worker keeps its own metrics, so each gets its own port
+    if borse.config.metrics_port:
+        asyncio.get_event_loop().run_until_complete(serve_metrics(
+            borse.config.metrics_host, borse.config.metrics_port + index))
+
     asyncio.get_event_loop().run_until_complete(app.post_events())
     asyncio.get_event_loop().run_forever()
     return 0
 
+def worker_main(index):
+    sys.exit(run_worker(index))
+
+def supervise(workers):
+    processes = [None] * workers
+    while True:
+        for i, process in enumerate(processes):
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                log.warning('worker %s exited with %s, restarting',
+                            i, process.exitcode)
+            processes[i] = multiprocessing.Process(target=worker_main,
+                                                   args=(i,))
+            processes[i].start()
+        time.sleep(1)
+
+def main():
+    if borse.config.workers > 1:
+        setup_logging()
+        return supervise(borse.config.workers)
+    return run_worker()
+
 if __name__ == '__main__':
     sys.exit(main())
-